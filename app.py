@@ -1,7 +1,13 @@
 import gradio as gr
-import requests
+from starlette.middleware import Middleware
 
-from config import LIGHTHOUZ_API_URL
+from clients import clients
+from config import (
+    QUEUE_CONCURRENCY_LIMIT,
+    STREAM_FRAME_INTERVAL_MS,
+    STREAM_FRAME_MIN_CHARS,
+)
+from fanout import ResponseBuffer, merge_streams
 from guardrails_buttons import (
     activate_button,
     activate_chat_buttons,
@@ -21,162 +27,206 @@ from guardrails_buttons import (
     show_models_fn,
     tievote,
 )
-from guardrails_models import (
-    get_all_models,
-    get_random_models,
-    get_random_system_prompt,
+from guardrails_models import get_all_models
+from health import health_tracker
+from hedging import hedger
+from history import history_manager
+from metering import meter
+from metrics import (
+    QueueTimer,
+    StatsCollector,
+    battles_in_flight,
+    frames_per_response,
+    metrics_endpoint,
+    observe_queue_wait,
+)
+from moderation_batcher import moderation_batcher
+from persistence import persistence_worker
+from prefilter import prefilter
+from rails_pool import rails_pool
+from sessions import get_session, session_store
+from speculative_moderation import speculation_stats
+from verdict_cache import verdict_cache
+from warmup import start_background_warmup
+
+
+def sensitive_data_stats():
+    # Imported on first use, as it imports nemoguardrails.
+    from sensitive_data import detector
+
+    return detector.stats()
+
+
+# The stats of the components, read on every scrape of /metrics.
+StatsCollector(
+    "arena_rails_pool",
+    "NeMo Guardrails instance pool",
+    rails_pool.stats,
+    counters=["hits", "misses", "evictions"],
+)
+StatsCollector(
+    "arena_clients",
+    "Upstream clients",
+    clients.stats,
+    counters=["chat_evictions"],
+)
+StatsCollector(
+    "arena_speculation",
+    "Speculative input moderation",
+    speculation_stats.stats,
+    counters=["runs", "blocked", "saved_seconds", "wasted_tokens"],
+)
+StatsCollector(
+    "arena_verdict_cache",
+    "Llama Guard verdict cache",
+    verdict_cache.stats,
+    counters=["memory_hits", "disk_hits", "misses", "coalesced"],
+)
+StatsCollector(
+    "arena_moderation_batcher",
+    "Llama Guard request batching",
+    moderation_batcher.stats,
+    counters=["batches", "prompts"],
 )
+StatsCollector(
+    "arena_prefilter",
+    "Local input prefilter",
+    prefilter.stats,
+    counters=["checked", "matches"],
+    labels={"matches": "pattern"},
+)
+StatsCollector(
+    "arena_history",
+    "Conversation windowing",
+    history_manager.stats,
+    counters=[
+        "windows",
+        "trimmed",
+        "dropped_turns",
+        "summarized",
+        "token_cache_hits",
+        "token_cache_misses",
+    ],
+)
+StatsCollector(
+    "arena_metering",
+    "Spend of today by arena model",
+    meter.stats,
+    labels={"models": "model"},
+)
+
+StatsCollector(
+    "arena_sensitive_data",
+    "Sensitive data detection",
+    sensitive_data_stats,
+    counters=["batches", "texts", "restarts"],
+)
+StatsCollector(
+    "arena_hedging",
+    "Upstream retries and hedged requests",
+    hedger.stats,
+    counters=[
+        "requests",
+        "retries",
+        "hedges_fired",
+        "hedges_won",
+        "budget_exhausted",
+        "deadlines_exceeded",
+    ],
+    labels={"hedge_after": "key"},
+)
+
+
+MODEL_ERROR_MESSAGE = "⚠️ I'm sorry, the model failed to respond. Please try again."
+
+
+async def stream_battle(
+    session, temperature, top_p, max_output_tokens, request: gr.Request
+):
+    """Stream the last turn of both histories of a session, then queue them
+    to be stored in the Lighthouz API."""
+    llms = session.llms
+    history1, history2 = session.histories
+    llm1_generator = llms[0]["model"](
+        history1, session.system_prompt, temperature, top_p, max_output_tokens
+    )
+    llm2_generator = llms[1]["model"](
+        history2, session.system_prompt, temperature, top_p, max_output_tokens
+    )
+    response1 = ResponseBuffer()
+    response2 = ResponseBuffer()
 
+    def side_error(index: int, error: Exception) -> str:
+        # Only the pane of the failed model shows the error.
+        print(f"{llms[index]['name']} failed: {error!r}")
+        return f"\n\n{MODEL_ERROR_MESSAGE}"
 
-def handle_message(
-    llms,
-    system_prompt,
+    observe_queue_wait(request, [llm["name"] for llm in llms])
+    with battles_in_flight.track():
+        # Each side streams at its own model's speed, coalesced into frames.
+        async for chunks1, chunks2 in merge_streams(
+            llm1_generator,
+            llm2_generator,
+            interval=STREAM_FRAME_INTERVAL_MS / 1000,
+            min_chars=STREAM_FRAME_MIN_CHARS,
+            on_error=side_error,
+        ):
+            if chunks1:
+                history1[-1] = (history1[-1][0], response1.extend(chunks1))
+            if chunks2:
+                history2[-1] = (history2[-1][0], response2.extend(chunks2))
+            yield history1, history2
+    frames_per_response.observe(response1.frames, model=llms[0]["name"])
+    frames_per_response.observe(response2.frames, model=llms[1]["name"])
+
+    # Stored by the persistence worker; a copy, as the histories change.
+    body = {"conversations": [list(history1), list(history2)]}
+    if "cf-connecting-ip" in request.headers:
+        ip = request.headers["cf-connecting-ip"]
+    else:
+        ip = request.client.host
+    persistence_worker.submit(
+        session, body, create={"models": [llms[0]["name"], llms[1]["name"]], "ip": ip}
+    )
+
+
+async def handle_message(
+    session_id,
     user_input,
     temperature,
     top_p,
     max_output_tokens,
-    states1,
-    states2,
-    conversation_id,
     request: gr.Request,
 ):
-    states = [states1, states2]
-    history1 = states1.value if states1 else []
-    history2 = states2.value if states2 else []
-    llm1 = llms[0]["model"]
-    llm2 = llms[1]["model"]
-    history1.append((user_input, None))
-    history2.append((user_input, None))
-    llm1_generator = llm1(
-        history1, system_prompt, temperature, top_p, max_output_tokens
-    )
-    llm2_generator = llm2(
-        history2, system_prompt, temperature, top_p, max_output_tokens
-    )
-    full_response1 = []
-    full_response2 = []
-    llm1_done = False
-    llm2_done = False
-    while not (llm1_done and llm2_done):
-        for i in range(2):
-            try:
-                if i == 0 and not llm1_done:
-                    gpt_response1 = next(llm1_generator)
-                    if gpt_response1:
-                        full_response1.append(gpt_response1)
-                        history1[-1] = (history1[-1][0], "".join(full_response1))
-                        states[0] = gr.State(history1)
-                elif i == 1 and not llm2_done:
-                    gpt_response2 = next(llm2_generator)
-                    if gpt_response2:
-                        full_response2.append(gpt_response2)
-                        history2[-1] = (history2[-1][0], "".join(full_response2))
-                        states[1] = gr.State(history2)
-            except StopIteration:
-                if i == 0:
-                    llm1_done = True
-                elif i == 1:
-                    llm2_done = True
-        yield history1, history2, states[0], states[1], conversation_id
-
-    if conversation_id and conversation_id.value:
-        requests.put(
-            f"{LIGHTHOUZ_API_URL}/{conversation_id.value}",
-            json={"conversations": [history1, history2]},
-        )
-    else:
-        if "cf-connecting-ip" in request.headers:
-            ip = request.headers["cf-connecting-ip"]
-        else:
-            ip = request.client.host
-        response = requests.post(
-            f"{LIGHTHOUZ_API_URL}/",
-            json={
-                "conversations": [history1, history2],
-                "models": [llms[0]["name"], llms[1]["name"]],
-                "ip": ip,
-            },
-        )
-        if response.status_code == 201:
-            conversation_id = response.json().get("_id")
-            conversation_id = gr.State(conversation_id)
-            yield history1, history2, states[0], states[1], conversation_id
+    session = get_session(session_id)
+    if not session.histories[0]:
+        # Sessions are also made on page loads and clears that never battle,
+        # so a half-open breaker's probe starts with the first message.
+        for llm in session.llms:
+            health_tracker.selected(llm["name"], llm["provider"])
+    for history in session.histories:
+        history.append((user_input, None))
+    async for histories in stream_battle(
+        session, temperature, top_p, max_output_tokens, request
+    ):
+        yield histories
 
 
-def regenerate_message(
-    llms,
-    system_prompt,
+async def regenerate_message(
+    session_id,
     temperature,
     top_p,
     max_output_tokens,
-    states1,
-    states2,
-    conversation_id,
     request: gr.Request,
 ):
-    # Initialize or update the history for each model
-    states = [states1, states2]
-    history1 = states1.value if states1 else []
-    history2 = states2.value if states2 else []
-    user_input = history1.pop()[0]
-    history2.pop()
-    llm1 = llms[0]["model"]
-    llm2 = llms[1]["model"]
-    history1.append((user_input, None))
-    history2.append((user_input, None))
-    llm1_generator = llm1(
-        history1, system_prompt, temperature, top_p, max_output_tokens
-    )
-    llm2_generator = llm2(
-        history2, system_prompt, temperature, top_p, max_output_tokens
-    )
-    full_response1 = []
-    full_response2 = []
-    llm1_done = False
-    llm2_done = False
-    while not (llm1_done and llm2_done):
-        for i in range(2):
-            try:
-                if i == 0 and not llm1_done:
-                    gpt_response1 = next(llm1_generator)
-                    if gpt_response1:
-                        full_response1.append(gpt_response1)
-                        history1[-1] = (history1[-1][0], "".join(full_response1))
-                        states[0] = gr.State(history1)
-                elif i == 1 and not llm2_done:
-                    gpt_response2 = next(llm2_generator)
-                    if gpt_response2:
-                        full_response2.append(gpt_response2)
-                        history2[-1] = (history2[-1][0], "".join(full_response2))
-                        states[1] = gr.State(history2)
-            except StopIteration:
-                if i == 0:
-                    llm1_done = True
-                elif i == 1:
-                    llm2_done = True
-        yield history1, history2, states[0], states[1], conversation_id
-    if conversation_id and conversation_id.value:
-        requests.put(
-            f"{LIGHTHOUZ_API_URL}/{conversation_id.value}",
-            json={"conversations": [history1, history2]},
-        )
-    else:
-        if "cf-connecting-ip" in request.headers:
-            ip = request.headers["cf-connecting-ip"]
-        else:
-            ip = request.client.host
-        response = requests.post(
-            f"{LIGHTHOUZ_API_URL}/",
-            json={
-                "conversations": [history1, history2],
-                "models": [llms[0]["name"], llms[1]["name"]],
-                "ip": ip,
-            },
-        )
-        if response.status_code == 201:
-            conversation_id = response.json().get("_id")
-            conversation_id = gr.State(conversation_id)
-            yield history1, history2, states[0], states[1], conversation_id
+    session = get_session(session_id)
+    for history in session.histories:
+        user_input = history.pop()[0]
+        history.append((user_input, None))
+    async for histories in stream_battle(
+        session, temperature, top_p, max_output_tokens, request
+    ):
+        yield histories
 
 
 with gr.Blocks(
@@ -278,13 +328,12 @@ with gr.Blocks(
         )
         # notice = gr.Markdown(notice_markdown, elem_id="notice_markdown")
         num_sides = 2
-        states = [gr.State() for _ in range(num_sides)]
         chatbots = [None] * num_sides
-        models = gr.State(get_random_models)
+        # The models, system prompt and histories of the round are kept in
+        # session_store; the UI only holds the session ID.
+        session = gr.State(lambda: session_store.new())
         rankings = gr.State("")
-        system_prompt = gr.State(get_random_system_prompt)
         show_models = [None] * num_sides
-        conversation_id = gr.State()
         all_models = get_all_models()
         with gr.Group(elem_id="share-region-annoy"):
             with gr.Accordion(
@@ -346,7 +395,7 @@ with gr.Blocks(
                 value="🎲 New Round",
                 elem_id="clear_btn",
                 interactive=False,
-                components=chatbots + states + show_models + [conversation_id],
+                components=chatbots + show_models,
             )
             regenerate_btn = gr.Button(
                 value="🔄 Regenerate", interactive=False, elem_id="regenerate_btn"
@@ -464,18 +513,8 @@ with gr.Blocks(
 
     textbox.submit(
         handle_message,
-        inputs=[
-            models,
-            system_prompt,
-            textbox,
-            temperature,
-            top_p,
-            max_output_tokens,
-            states[0],
-            states[1],
-            conversation_id,
-        ],
-        outputs=[chatbots[0], chatbots[1], states[0], states[1], conversation_id],
+        inputs=[session, textbox, temperature, top_p, max_output_tokens],
+        outputs=[chatbots[0], chatbots[1]],
     ).then(
         activate_chat_buttons,
         inputs=[],
@@ -487,18 +526,8 @@ with gr.Blocks(
     )
     send_btn.click(
         handle_message,
-        inputs=[
-            models,
-            system_prompt,
-            textbox,
-            temperature,
-            top_p,
-            max_output_tokens,
-            states[0],
-            states[1],
-            conversation_id,
-        ],
-        outputs=[chatbots[0], chatbots[1], states[0], states[1], conversation_id],
+        inputs=[session, textbox, temperature, top_p, max_output_tokens],
+        outputs=[chatbots[0], chatbots[1]],
     ).then(
         activate_chat_buttons,
         inputs=[],
@@ -511,17 +540,8 @@ with gr.Blocks(
 
     regenerate_btn.click(
         regenerate_message,
-        inputs=[
-            models,
-            system_prompt,
-            temperature,
-            top_p,
-            max_output_tokens,
-            states[0],
-            states[1],
-            conversation_id,
-        ],
-        outputs=[chatbots[0], chatbots[1], states[0], states[1], conversation_id],
+        inputs=[session, temperature, top_p, max_output_tokens],
+        outputs=[chatbots[0], chatbots[1]],
     ).then(
         activate_visible_vote_buttons,
         inputs=[],
@@ -537,9 +557,7 @@ with gr.Blocks(
         inputs=[],
         outputs=[leftvote_btn, rightvote_btn, tie_btn, bothbad_btn],
     ).then(
-        lambda: get_random_models(), inputs=None, outputs=[models]
-    ).then(
-        lambda: get_random_system_prompt(), inputs=None, outputs=[system_prompt]
+        session_store.renew, inputs=[session], outputs=[session]
     ).then(
         activate_button,
         inputs=[],
@@ -551,14 +569,14 @@ with gr.Blocks(
     )
 
     leftvote_btn.click(
-        leftvote, inputs=[conversation_id, states[0], states[1]], outputs=[]
+        leftvote, inputs=[session], outputs=[]
     ).then(
         deactivate_visible_vote_buttons,
         inputs=[],
         outputs=[leftvote_btn, rightvote_btn, tie_btn, bothbad_btn],
     ).then(
         show_models_fn,
-        inputs=[models],
+        inputs=[session],
         outputs=[show_models[0], show_models[1]],
     ).then(
         deactivate_button,
@@ -574,14 +592,14 @@ with gr.Blocks(
         outputs=[textbox],
     )
     rightvote_btn.click(
-        rightvote, inputs=[conversation_id, states[0], states[1]], outputs=[]
+        rightvote, inputs=[session], outputs=[]
     ).then(
         deactivate_visible_vote_buttons,
         inputs=[],
         outputs=[leftvote_btn, rightvote_btn, tie_btn, bothbad_btn],
     ).then(
         show_models_fn,
-        inputs=[models],
+        inputs=[session],
         outputs=[show_models[0], show_models[1]],
     ).then(
         deactivate_button,
@@ -597,14 +615,14 @@ with gr.Blocks(
         outputs=[textbox],
     )
     tie_btn.click(
-        tievote, inputs=[conversation_id, states[0], states[1]], outputs=[]
+        tievote, inputs=[session], outputs=[]
     ).then(
         deactivate_visible_vote_buttons,
         inputs=[],
         outputs=[leftvote_btn, rightvote_btn, tie_btn, bothbad_btn],
     ).then(
         show_models_fn,
-        inputs=[models],
+        inputs=[session],
         outputs=[show_models[0], show_models[1]],
     ).then(
         deactivate_button,
@@ -620,14 +638,14 @@ with gr.Blocks(
         outputs=[textbox],
     )
     bothbad_btn.click(
-        bothbadvote, inputs=[conversation_id, states[0], states[1]], outputs=[]
+        bothbadvote, inputs=[session], outputs=[]
     ).then(
         deactivate_visible_vote_buttons,
         inputs=[],
         outputs=[leftvote_btn, rightvote_btn, tie_btn, bothbad_btn],
     ).then(
         show_models_fn,
-        inputs=[models],
+        inputs=[session],
         outputs=[show_models[0], show_models[1]],
     ).then(
         deactivate_button,
@@ -649,6 +667,20 @@ with gr.Blocks(
 
     # random_example_btn.click(textbox_random_example, inputs=[], outputs=[textbox])
 
+    demo.load(clients.warmup, inputs=None, outputs=None)
+
 if __name__ == "__main__":
-    demo.queue(default_concurrency_limit=10)
-    demo.launch(show_api=False, allowed_paths=["./static"])
+    demo.queue(default_concurrency_limit=QUEUE_CONCURRENCY_LIMIT)
+    demo.launch(
+        show_api=False,
+        allowed_paths=["./static"],
+        prevent_thread_lock=True,
+        app_kwargs={"middleware": [Middleware(QueueTimer)]},
+    )
+    # Circuit breaker states and Prometheus metrics, next to the Gradio routes.
+    demo.app.add_api_route("/health", health_tracker.stats, methods=["GET"])
+    demo.app.add_api_route("/metrics", metrics_endpoint, methods=["GET"])
+    start_background_warmup()
+    # Sends what an earlier process left in the outbox.
+    persistence_worker.start()
+    demo.block_thread()
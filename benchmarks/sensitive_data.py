@@ -0,0 +1,122 @@
+"""Throughput benchmark for sensitive data detection.
+
+Runs the "detect sensitive data on output" check of nemoguardrails_config over
+bot-like messages, in a thread (pool size 0) and in worker pools of the given
+sizes, and reports detections per second overall and per worker core.
+
+    python benchmarks/sensitive_data.py --workers 0,1,2,4 --output sdd.json
+    python benchmarks/sensitive_data.py --model en_core_web_sm
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SAFE = [
+    "I'm sorry to hear that your card was declined.",
+    "You can reset your online banking password from the login page.",
+    "Our branches are open from 9am to 5pm on weekdays.",
+    "Is there anything else I can help you with today?",
+    "Transfers between your own accounts are free of charge.",
+]
+SENSITIVE = [
+    "The account holder is Charles Dickens, born on March 1, 1990.",
+    "You can reach the customer at cdickens@gmail.com or 123-456-7890.",
+    "The SSN on file is 20482048 and the account number is 1048576.",
+    "The customer lives at 10, 24 St, San Francisco, California.",
+]
+
+
+def messages(count: int, seed: int = 0):
+    rng = random.Random(seed)
+    return [
+        " ".join(rng.choice(SAFE + SENSITIVE) for _ in range(rng.randint(2, 6)))
+        for _ in range(count)
+    ]
+
+
+async def run(detector, config, texts, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def detect(text):
+        async with semaphore:
+            return await detector.detect("output", text, config)
+
+    started = time.perf_counter()
+    results = await asyncio.gather(*[detect(text) for text in texts])
+    return time.perf_counter() - started, sum(results)
+
+
+def measure(pool_size, model, config, texts, batch_size, concurrency):
+    from sensitive_data import SensitiveDataDetector
+
+    detector = SensitiveDataDetector(
+        pool_size=pool_size, model_name=model, max_batch_size=batch_size
+    )
+    started = time.perf_counter()
+    detector.start()
+    startup = time.perf_counter() - started
+    asyncio.run(run(detector, config, texts[:concurrency], concurrency))
+    seconds, flagged = asyncio.run(run(detector, config, texts, concurrency))
+    if detector._pool is not None:
+        detector._pool.shutdown()
+    rate = len(texts) / seconds
+    return {
+        "startup": startup,
+        "seconds": seconds,
+        "flagged": flagged,
+        "detections_per_second": rate,
+        "detections_per_second_per_core": rate / max(1, pool_size),
+        "mean_batch_size": detector.stats()["mean_batch_size"],
+    }
+
+
+def main():
+    sys.path.insert(0, ROOT)
+    from config import SDD_BATCH_MAX_SIZE, SDD_SPACY_MODEL
+    from rails_pool import rails_pool
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", default="0,1,2", help="pool sizes to compare")
+    parser.add_argument("--model", default=SDD_SPACY_MODEL)
+    parser.add_argument("--texts", type=int, default=400)
+    parser.add_argument("--batch-size", type=int, default=SDD_BATCH_MAX_SIZE)
+    parser.add_argument(
+        "--concurrency", type=int, default=32, help="detections in flight"
+    )
+    parser.add_argument("--output", help="write the report as JSON")
+    args = parser.parse_args()
+
+    texts = messages(args.texts)
+    report = {
+        "model": args.model,
+        "texts": args.texts,
+        "batch_size": args.batch_size,
+        "concurrency": args.concurrency,
+        "cpus": os.cpu_count(),
+        "pools": {},
+    }
+    for pool_size in [int(size) for size in args.workers.split(",")]:
+        report["pools"][pool_size] = measure(
+            pool_size,
+            args.model,
+            rails_pool.config,
+            texts,
+            args.batch_size,
+            args.concurrency,
+        )
+
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,382 @@
+"""OpenAI-compatible stand-in for the upstream APIs, for offline testing.
+
+Serves /v1/chat/completions, /v1/completions and /v1/models, streaming and
+non-streaming, with synthetic tokens. Time to first token and inter-token
+latency are drawn from log-normal distributions, and 429 and 500 errors are
+injected at the given rates. Llama Guard (completions) and the NeMo
+Guardrails self checks (chat) get scripted verdicts: unsafe when the checked
+message contains --unsafe-input or --unsafe-output, or at --unsafe-rate. A
+user message containing --unsafe-output gets a reply that contains it too.
+A stub of the Lighthouz API, which stores battles and votes, is served
+under /lighthouz. It versions each conversation and also takes the delta
+updates of PERSISTENCE_DELTAS=true: a PATCH with the turns from `start` on,
+applied if the conversation is still at `base_version`, else 409.
+
+    python benchmarks/standin.py --port 8008 --ttft 0.4 --itl 0.03
+    python benchmarks/standin.py --error-429 0.05 --error-500 0.01
+
+Point the arena at it with:
+
+    OPENAI_BASE_URL=http://127.0.0.1:8008/v1
+    ANYSCALE_ENDPOINTS_URL=http://127.0.0.1:8008/v1
+    ANYSCALE_BASE_URL=http://127.0.0.1:8008/v1
+    GEMINI_BASE_URL=http://127.0.0.1:8008/v1
+    LIGHTHOUZ_API_URL=http://127.0.0.1:8008/lighthouz
+    OPENAI_API_KEY=standin ANYSCALE_API_KEY=standin GOOGLE_API_KEY=standin
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import random
+import time
+import uuid
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+
+WORDS = (
+    "Thank you for contacting XYZ001 bank. I can help you with your account, "
+    "cards, transfers and online banking. Please note that for your security "
+    "I cannot share personal details over chat. Is there anything else I can "
+    "help you with today?"
+).split()
+
+# The questions of nemoguardrails_config/prompts.yml.
+SELF_CHECK_INPUT = "Should the user message be blocked"
+SELF_CHECK_OUTPUT = "Should the message be blocked"
+
+
+@dataclass
+class Settings:
+    ttft: float = 0.3
+    ttft_sigma: float = 0.5
+    itl: float = 0.02
+    itl_sigma: float = 0.3
+    min_tokens: int = 20
+    max_tokens: int = 120
+    error_429: float = 0.0
+    error_500: float = 0.0
+    unsafe_rate: float = 0.0
+    unsafe_input: str = "[unsafe-input]"
+    unsafe_output: str = "[unsafe-output]"
+    lighthouz_latency: float = 0.05
+    seed: Optional[int] = None
+
+
+def _lognormal(rng: random.Random, median: float, sigma: float) -> float:
+    if median <= 0:
+        return 0.0
+    return rng.lognormvariate(math.log(median), sigma)
+
+
+def _count_tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+
+class StandIn:
+    def __init__(self, settings: Settings):
+        self.settings = settings
+        self.rng = random.Random(settings.seed)
+        self.requests = 0
+        self.errors = 0
+        self.conversations = {}
+        self.lighthouz_bytes = 0
+
+    def error(self) -> Optional[Tuple[int, dict]]:
+        roll = self.rng.random()
+        if roll < self.settings.error_429:
+            kind, status = "rate_limit_error", 429
+        elif roll < self.settings.error_429 + self.settings.error_500:
+            kind, status = "server_error", 500
+        else:
+            return None
+        self.errors += 1
+        return status, {"error": {"message": "Injected by the stand-in", "type": kind}}
+
+    def _unsafe(self, text: str, marker: str) -> bool:
+        return marker in text or self.rng.random() < self.settings.unsafe_rate
+
+    def verdict(self, prompt: str) -> str:
+        """Llama Guard's answer to one of llamaguard_moderator's prompts."""
+        checks_user = "'User' messages" in prompt
+        conversation = prompt.split("<BEGIN CONVERSATION>")[-1]
+        conversation = conversation.split("<END CONVERSATION>")[0]
+        if checks_user:
+            unsafe = self._unsafe(conversation, self.settings.unsafe_input)
+        else:
+            agent = conversation.split("Agent:", 1)[-1]
+            unsafe = self._unsafe(agent, self.settings.unsafe_output)
+        return "unsafe\nO9" if unsafe else "safe"
+
+    def reply(self, messages: List[dict], max_tokens: Optional[int]) -> List[str]:
+        """The tokens of the reply to a chat, or the answer to a self check."""
+        last = str(messages[-1].get("content", "")) if messages else ""
+        if SELF_CHECK_INPUT in last:
+            return ["Yes" if self._unsafe(last, self.settings.unsafe_input) else "No"]
+        if SELF_CHECK_OUTPUT in last:
+            return ["Yes" if self._unsafe(last, self.settings.unsafe_output) else "No"]
+        count = self.rng.randint(self.settings.min_tokens, self.settings.max_tokens)
+        if max_tokens:
+            count = min(count, max_tokens)
+        tokens = [(" " if i else "") + WORDS[i % len(WORDS)] for i in range(count)]
+        if self.settings.unsafe_output in last:
+            tokens.append(" " + self.settings.unsafe_output)
+        return tokens
+
+    async def tokens(self, tokens: List[str]):
+        await asyncio.sleep(
+            _lognormal(self.rng, self.settings.ttft, self.settings.ttft_sigma)
+        )
+        for index, token in enumerate(tokens):
+            if index:
+                await asyncio.sleep(
+                    _lognormal(self.rng, self.settings.itl, self.settings.itl_sigma)
+                )
+            yield token
+
+
+def create_app(settings: Settings):
+    from fastapi import FastAPI, Request
+    from fastapi.responses import JSONResponse, StreamingResponse
+
+    app = FastAPI()
+    standin = StandIn(settings)
+
+    def _sse(payloads):
+        async def events():
+            async for payload in payloads:
+                yield f"data: {json.dumps(payload)}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    @app.get("/v1/models")
+    async def models():
+        return {"object": "list", "data": []}
+
+    @app.get("/stats")
+    async def stats():
+        return {
+            "requests": standin.requests,
+            "errors": standin.errors,
+            "conversations": len(standin.conversations),
+            "lighthouz_bytes": standin.lighthouz_bytes,
+        }
+
+    async def lighthouz_latency():
+        await asyncio.sleep(
+            _lognormal(standin.rng, settings.lighthouz_latency, settings.ttft_sigma)
+        )
+
+    async def lighthouz_body(request: Request) -> dict:
+        data = await request.body()
+        standin.lighthouz_bytes += len(data)
+        await lighthouz_latency()
+        return json.loads(data)
+
+    @app.post("/lighthouz/")
+    async def create_conversation(request: Request):
+        body = await lighthouz_body(request)
+        conversation_id = uuid.uuid4().hex
+        standin.conversations[conversation_id] = {**body, "version": 1}
+        return JSONResponse({"_id": conversation_id, "version": 1}, status_code=201)
+
+    @app.put("/lighthouz/{conversation_id}")
+    async def update_conversation(conversation_id: str, request: Request):
+        body = await lighthouz_body(request)
+        conversation = standin.conversations.setdefault(conversation_id, {})
+        conversation.update(body)
+        conversation["version"] = conversation.get("version", 0) + 1
+        return {"_id": conversation_id, "version": conversation["version"]}
+
+    @app.patch("/lighthouz/{conversation_id}")
+    async def append_turns(conversation_id: str, request: Request):
+        body = await lighthouz_body(request)
+        conversation = standin.conversations.get(conversation_id)
+        if conversation is None:
+            return JSONResponse({"error": "Not found"}, status_code=404)
+        version = conversation.get("version", 0)
+        if body.pop("base_version", None) != version:
+            return JSONResponse({"version": version}, status_code=409)
+        start = body.pop("start")
+        turns = body.pop("turns")
+        conversations = conversation.get("conversations") or [[] for _ in turns]
+        if len(conversations) != len(turns) or any(
+            len(history) < start for history in conversations
+        ):
+            return JSONResponse({"version": version}, status_code=409)
+        conversation["conversations"] = [
+            history[:start] + new for history, new in zip(conversations, turns)
+        ]
+        conversation.update(body)
+        conversation["version"] = version + 1
+        return {"_id": conversation_id, "version": version + 1}
+
+    @app.get("/lighthouz/rankings")
+    async def rankings():
+        await lighthouz_latency()
+        return {"ratings": {}}
+
+    @app.get("/lighthouz/{conversation_id}")
+    async def get_conversation(conversation_id: str):
+        conversation = standin.conversations.get(conversation_id)
+        if conversation is None:
+            return JSONResponse({"error": "Not found"}, status_code=404)
+        return {"_id": conversation_id, **conversation}
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        standin.requests += 1
+        error = standin.error()
+        if error:
+            return JSONResponse(error[1], status_code=error[0])
+        messages = body.get("messages", [])
+        tokens = standin.reply(messages, body.get("max_tokens"))
+        usage = {
+            "prompt_tokens": sum(
+                _count_tokens(str(m.get("content", ""))) for m in messages
+            ),
+            "completion_tokens": len(tokens),
+        }
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        base = {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "created": int(time.time()),
+            "model": body.get("model", "standin"),
+        }
+
+        if not body.get("stream"):
+            text = "".join([token async for token in standin.tokens(tokens)])
+            return {
+                **base,
+                "object": "chat.completion",
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {"role": "assistant", "content": text},
+                        "finish_reason": "stop",
+                    }
+                ],
+                "usage": usage,
+            }
+
+        async def chunks():
+            async for token in standin.tokens(tokens):
+                yield {
+                    **base,
+                    "object": "chat.completion.chunk",
+                    "choices": [
+                        {"index": 0, "delta": {"content": token}, "finish_reason": None}
+                    ],
+                }
+            yield {
+                **base,
+                "object": "chat.completion.chunk",
+                "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+                "usage": usage,
+            }
+
+        return _sse(chunks())
+
+    @app.post("/v1/completions")
+    async def completions(request: Request):
+        body = await request.json()
+        standin.requests += 1
+        error = standin.error()
+        if error:
+            return JSONResponse(error[1], status_code=error[0])
+        prompts = body.get("prompt", "")
+        if isinstance(prompts, str):
+            prompts = [prompts]
+        texts = [
+            (
+                standin.verdict(prompt)
+                if "guard" in body.get("model", "").lower()
+                else "".join(
+                    standin.reply([{"content": prompt}], body.get("max_tokens"))
+                )
+            )
+            for prompt in prompts
+        ]
+        # One latency for the batch, as for a batched forward pass.
+        async for _ in standin.tokens([""]):
+            pass
+        base = {
+            "id": f"cmpl-{uuid.uuid4().hex}",
+            "created": int(time.time()),
+            "model": body.get("model", "standin"),
+        }
+        choices = [
+            {"index": index, "text": text, "finish_reason": "stop", "logprobs": None}
+            for index, text in enumerate(texts)
+        ]
+        usage = {
+            "prompt_tokens": sum(_count_tokens(prompt) for prompt in prompts),
+            "completion_tokens": sum(_count_tokens(text) for text in texts),
+        }
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        if not body.get("stream"):
+            return {
+                **base,
+                "object": "text_completion",
+                "choices": choices,
+                "usage": usage,
+            }
+
+        async def chunks():
+            for choice in choices:
+                yield {**base, "object": "text_completion", "choices": [choice]}
+
+        return _sse(chunks())
+
+    return app
+
+
+def main():
+    import uvicorn
+
+    defaults = Settings()
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8008)
+    parser.add_argument("--ttft", type=float, default=defaults.ttft, help="median")
+    parser.add_argument("--ttft-sigma", type=float, default=defaults.ttft_sigma)
+    parser.add_argument("--itl", type=float, default=defaults.itl, help="median")
+    parser.add_argument("--itl-sigma", type=float, default=defaults.itl_sigma)
+    parser.add_argument("--min-tokens", type=int, default=defaults.min_tokens)
+    parser.add_argument("--max-tokens", type=int, default=defaults.max_tokens)
+    parser.add_argument("--error-429", type=float, default=0.0, help="rate")
+    parser.add_argument("--error-500", type=float, default=0.0, help="rate")
+    parser.add_argument("--unsafe-rate", type=float, default=0.0)
+    parser.add_argument("--unsafe-input", default=defaults.unsafe_input)
+    parser.add_argument("--unsafe-output", default=defaults.unsafe_output)
+    parser.add_argument(
+        "--lighthouz-latency", type=float, default=defaults.lighthouz_latency
+    )
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    settings = Settings(
+        ttft=args.ttft,
+        ttft_sigma=args.ttft_sigma,
+        itl=args.itl,
+        itl_sigma=args.itl_sigma,
+        min_tokens=args.min_tokens,
+        max_tokens=args.max_tokens,
+        error_429=args.error_429,
+        error_500=args.error_500,
+        unsafe_rate=args.unsafe_rate,
+        unsafe_input=args.unsafe_input,
+        unsafe_output=args.unsafe_output,
+        lighthouz_latency=args.lighthouz_latency,
+        seed=args.seed,
+    )
+    uvicorn.run(
+        create_app(settings), host=args.host, port=args.port, log_level="warning"
+    )
+
+
+if __name__ == "__main__":
+    main()
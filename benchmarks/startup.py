@@ -0,0 +1,141 @@
+"""Startup-time benchmark for the arena.
+
+Breaks the cold start down into the import of app.py (per module, from
+`python -X importtime`), the first-use cost of every lazily imported provider
+module, and optionally the first-request latency of each arena model, each
+measured in a fresh interpreter.
+
+    python benchmarks/startup.py --budget 6 --output startup.json
+    python benchmarks/startup.py --models  # needs API keys or a stand-in server
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+from collections import defaultdict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+FIRST_REQUEST = """
+import asyncio, json, sys, time
+started = time.perf_counter()
+import app
+imported = time.perf_counter() - started
+from guardrails_models import get_all_models
+
+async def main():
+    model = next(m for m in get_all_models() if m["name"] == sys.argv[1])
+    history = [("What is my account balance?", None)]
+    started = time.perf_counter()
+    first_token = None
+    async for chunk in model["model"](history, "You are a bank chatbot.", 0, 1, 64):
+        if first_token is None:
+            first_token = time.perf_counter() - started
+    return first_token, time.perf_counter() - started
+
+first_token, total = asyncio.run(main())
+print(json.dumps({"import": imported, "first_token": first_token, "total": total}))
+"""
+
+FIRST_USE = """
+import json
+import app
+import warmup
+print(json.dumps(warmup.warm_up()))
+"""
+
+
+def run_python(args):
+    return subprocess.run(
+        [sys.executable, *args], cwd=ROOT, capture_output=True, text=True, check=True
+    )
+
+
+def import_breakdown(top: int):
+    result = run_python(["-X", "importtime", "-c", "import app"])
+    modules = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if not cumulative.strip().isdigit():
+            continue
+        depth = (len(name) - len(name.lstrip())) // 2
+        modules.append((depth, name.strip(), int(cumulative) / 1e6))
+    total = next(seconds for depth, name, seconds in modules if name == "app")
+    by_package = defaultdict(float)
+    for depth, name, seconds in modules:
+        # Depth 1 modules are imported directly by app.py, depth 2 by those.
+        if depth in (1, 2):
+            by_package[name.split(".")[0]] = max(
+                by_package[name.split(".")[0]], seconds
+            )
+    ranked = sorted(by_package.items(), key=lambda item: item[1], reverse=True)
+    return {
+        "app": total,
+        "modules": dict(ranked[:top]),
+        "imported": sorted({name for _, name, _ in modules}),
+    }
+
+
+def first_use():
+    return json.loads(run_python(["-c", FIRST_USE]).stdout.splitlines()[-1])
+
+
+def first_requests():
+    sys.path.insert(0, ROOT)
+    from guardrails_models import get_all_models
+
+    results = {}
+    for model in get_all_models():
+        try:
+            output = run_python(["-c", FIRST_REQUEST, model["name"]]).stdout
+            results[model["name"]] = json.loads(output.splitlines()[-1])
+        except subprocess.CalledProcessError as e:
+            results[model["name"]] = {"error": e.stderr.strip().splitlines()[-1]}
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument(
+        "--budget", type=float, help="fail if importing app.py takes longer"
+    )
+    parser.add_argument(
+        "--models", action="store_true", help="measure first request per model"
+    )
+    parser.add_argument("--output", help="write the report as JSON")
+    args = parser.parse_args()
+
+    breakdown = import_breakdown(args.top)
+    report = {
+        "import": {"app": breakdown["app"], "modules": breakdown["modules"]},
+        "first_use": first_use(),
+    }
+    lazy = [
+        name
+        for name in ("nemoguardrails", "langchain_google_genai", "google.generativeai")
+        if name in breakdown["imported"]
+    ]
+    report["eagerly_imported_providers"] = lazy
+    if args.models:
+        report["first_request"] = first_requests()
+
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.budget is not None and breakdown["app"] > args.budget:
+        print(
+            f"Importing app.py took {breakdown['app']:.2f}s, "
+            f"over the {args.budget:.2f}s budget",
+            file=sys.stderr,
+        )
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,279 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Dict, Hashable, Optional
+
+import httpx
+
+from config import (
+    CHAT_CLIENT_CACHE_SIZE,
+    CLIENT_WARMUP,
+    HTTP_KEEPALIVE_EXPIRY,
+    HTTP_MAX_CONNECTIONS,
+    HTTP_MAX_KEEPALIVE_CONNECTIONS,
+    HTTP_TIMEOUT,
+)
+from metering import metering_callback
+
+ANYSCALE_ENDPOINTS_URL = os.environ.get(
+    "ANYSCALE_ENDPOINTS_URL", "https://api.endpoints.anyscale.com/v1"
+)
+OPENAI_URL = "https://api.openai.com/v1"
+# An OpenAI-compatible server to send the Gemini calls to instead, such as
+# benchmarks/standin.py. The Gemini API itself is gRPC.
+GEMINI_BASE_URL = os.environ.get("GEMINI_BASE_URL")
+
+# Provider SDKs are imported on first use: importing all of them up front
+# dominated the Space's cold start, while a battle only needs two models.
+if TYPE_CHECKING:
+    import openai
+    from langchain_google_genai import ChatGoogleGenerativeAI
+    from langchain_openai import ChatOpenAI
+
+
+def _gemini_safety_settings_none():
+    from google.generativeai.types import HarmBlockThreshold, HarmCategory
+
+    return {
+        HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
+        HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_NONE,
+        HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
+        HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
+    }
+
+
+class ClientRegistry:
+    """Long-lived upstream clients shared by every model function.
+
+    HTTP clients are keyed by (base_url, api_key), so each host gets a single
+    keep-alive connection pool capped at HTTP_MAX_CONNECTIONS. LangChain chat
+    models carry their generation parameters, which users pick freely, so they
+    are kept in an LRU cache of chat_cache_size entries instead. All clients
+    are async and are meant to be used from the Gradio event loop.
+    """
+
+    def __init__(self, chat_cache_size: int = CHAT_CLIENT_CACHE_SIZE):
+        self._lock = threading.RLock()
+        self._clients: Dict[Hashable, object] = {}
+        self._chat_clients: "OrderedDict[Hashable, object]" = OrderedDict()
+        self.chat_cache_size = chat_cache_size
+        self.chat_evictions = 0
+        self._warmed_up = False
+
+    def _get_or_create(self, key: Hashable, factory):
+        client = self._clients.get(key)
+        if client is None:
+            with self._lock:
+                client = self._clients.get(key)
+                if client is None:
+                    client = factory()
+                    self._clients[key] = client
+        return client
+
+    def _get_or_create_chat(self, key: Hashable, factory):
+        with self._lock:
+            client = self._chat_clients.get(key)
+            if client is not None:
+                self._chat_clients.move_to_end(key)
+                return client
+            client = factory()
+            self._chat_clients[key] = client
+            while len(self._chat_clients) > max(1, self.chat_cache_size):
+                self._chat_clients.popitem(last=False)
+                self.chat_evictions += 1
+        return client
+
+    def http_client(self, base_url: str) -> httpx.AsyncClient:
+        return self._get_or_create(
+            ("http", base_url),
+            lambda: httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=HTTP_MAX_CONNECTIONS,
+                    max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                    keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+                ),
+                timeout=HTTP_TIMEOUT,
+            ),
+        )
+
+    def openai_client(
+        self, base_url: Optional[str] = None, api_key: Optional[str] = None
+    ) -> "openai.AsyncOpenAI":
+        import openai
+
+        base_url = base_url or os.environ.get("OPENAI_BASE_URL", OPENAI_URL)
+        return self._get_or_create(
+            ("openai", base_url, api_key),
+            lambda: openai.AsyncOpenAI(
+                base_url=base_url,
+                api_key=api_key,
+                http_client=self.http_client(base_url),
+                # Retries are left to hedging.Hedger.
+                max_retries=0,
+            ),
+        )
+
+    def anyscale(self) -> "openai.AsyncOpenAI":
+        return self.openai_client(
+            ANYSCALE_ENDPOINTS_URL, os.environ.get("ANYSCALE_API_KEY")
+        )
+
+    def llamaguard(self) -> "openai.AsyncOpenAI":
+        return self.openai_client(
+            os.environ.get("ANYSCALE_BASE_URL"), os.environ.get("ANYSCALE_API_KEY")
+        )
+
+    def chat_openai(
+        self,
+        model_name: str,
+        temperature: float,
+        top_p: float,
+        max_output_tokens: int,
+        streaming: bool = False,
+        max_retries: int = 0,
+    ) -> "ChatOpenAI":
+        from langchain_openai import ChatOpenAI
+
+        base_url = os.environ.get("OPENAI_BASE_URL", OPENAI_URL)
+        return self._get_or_create_chat(
+            (
+                "chat_openai",
+                model_name,
+                temperature,
+                top_p,
+                max_output_tokens,
+                streaming,
+                max_retries,
+            ),
+            lambda: ChatOpenAI(
+                temperature=temperature,
+                max_retries=max_retries,
+                streaming=streaming,
+                callbacks=[metering_callback],
+                model_name=model_name,
+                metadata={"top_p": top_p, "max_output_tokens": max_output_tokens},
+                base_url=base_url,
+                http_async_client=self.http_client(base_url),
+            ),
+        )
+
+    def chat_anyscale(
+        self,
+        model: str,
+        temperature: float,
+        top_p: float,
+        max_output_tokens: int,
+        streaming: bool = False,
+        max_retries: int = 0,
+    ) -> "ChatOpenAI":
+        from langchain_openai import ChatOpenAI
+
+        # Anyscale Endpoints speak the OpenAI API; ChatAnyscale would also fetch
+        # the model list on construction and ignore the shared HTTP client.
+        return self._get_or_create_chat(
+            (
+                "chat_anyscale",
+                model,
+                temperature,
+                top_p,
+                max_output_tokens,
+                streaming,
+                max_retries,
+            ),
+            lambda: ChatOpenAI(
+                model_name=model,
+                temperature=temperature,
+                max_retries=max_retries,
+                streaming=streaming,
+                callbacks=[metering_callback],
+                metadata={"top_p": top_p, "max_output_tokens": max_output_tokens},
+                base_url=ANYSCALE_ENDPOINTS_URL,
+                api_key=os.environ.get("ANYSCALE_API_KEY"),
+                http_async_client=self.http_client(ANYSCALE_ENDPOINTS_URL),
+            ),
+        )
+
+    def chat_gemini(
+        self,
+        temperature: float,
+        top_p: float,
+        max_output_tokens: int,
+        block_none: bool = False,
+        max_retries: int = 0,
+    ) -> "ChatGoogleGenerativeAI":
+        if GEMINI_BASE_URL:
+            return self._chat_gemini_standin(
+                temperature, top_p, max_output_tokens, max_retries
+            )
+        from langchain_google_genai import ChatGoogleGenerativeAI
+
+        return self._get_or_create_chat(
+            (
+                "chat_gemini",
+                temperature,
+                top_p,
+                max_output_tokens,
+                block_none,
+                max_retries,
+            ),
+            lambda: ChatGoogleGenerativeAI(
+                model="gemini-pro",
+                convert_system_message_to_human=True,
+                temperature=temperature,
+                max_retries=max_retries,
+                callbacks=[metering_callback],
+                metadata={"top_p": top_p, "max_output_tokens": max_output_tokens},
+                safety_settings=_gemini_safety_settings_none() if block_none else None,
+            ),
+        )
+
+    def _chat_gemini_standin(
+        self, temperature: float, top_p: float, max_output_tokens: int, max_retries: int
+    ) -> "ChatOpenAI":
+        from langchain_openai import ChatOpenAI
+
+        return self._get_or_create_chat(
+            ("chat_gemini_standin", temperature, top_p, max_output_tokens, max_retries),
+            lambda: ChatOpenAI(
+                model_name="gemini-pro",
+                temperature=temperature,
+                max_retries=max_retries,
+                callbacks=[metering_callback],
+                metadata={"top_p": top_p, "max_output_tokens": max_output_tokens},
+                base_url=GEMINI_BASE_URL,
+                api_key=os.environ.get("GOOGLE_API_KEY"),
+                http_async_client=self.http_client(GEMINI_BASE_URL),
+            ),
+        )
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "chat_clients": len(self._chat_clients),
+                "chat_evictions": self.chat_evictions,
+            }
+
+    async def warmup(self):
+        # Open one connection per upstream host so the first battle does not
+        # pay for DNS and the TLS handshake.
+        if not CLIENT_WARMUP or self._warmed_up:
+            return
+        self._warmed_up = True
+        for get_client in (self.openai_client, self.anyscale, self.llamaguard):
+            try:
+                await get_client().models.list()
+            except Exception as e:
+                print(e)
+
+    async def aclose(self):
+        with self._lock:
+            http_clients = [
+                client for key, client in self._clients.items() if key[0] == "http"
+            ]
+            self._clients.clear()
+            self._chat_clients.clear()
+        for client in http_clients:
+            await client.aclose()
+
+
+clients = ClientRegistry()
@@ -1,3 +1,4 @@
+import json
 import os
 
 from dotenv import load_dotenv
@@ -5,3 +6,142 @@ from dotenv import load_dotenv
 load_dotenv()
 
 LIGHTHOUZ_API_URL = os.getenv("LIGHTHOUZ_API_URL")
+
+NEMOGUARDRAILS_CONFIG_PATH = os.getenv(
+    "NEMOGUARDRAILS_CONFIG_PATH", "./nemoguardrails_config"
+)
+RAILS_POOL_MAX_SIZE = int(os.getenv("RAILS_POOL_MAX_SIZE", "16"))
+RAILS_POOL_IDLE_TTL = float(os.getenv("RAILS_POOL_IDLE_TTL", "1800"))
+RAILS_POOL_BUILD_THREADS = int(os.getenv("RAILS_POOL_BUILD_THREADS", "2"))
+
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", "20"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "60"))
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "600"))
+CLIENT_WARMUP = os.getenv("CLIENT_WARMUP", "false").lower() == "true"
+# LangChain chat models kept per generation parameters, least recently used
+# first out. They share the HTTP clients above, so evicting one is cheap.
+CHAT_CLIENT_CACHE_SIZE = int(os.getenv("CHAT_CLIENT_CACHE_SIZE", "64"))
+
+LLAMAGUARD_STREAMING = os.getenv("LLAMAGUARD_STREAMING", "false").lower() == "true"
+LLAMAGUARD_WINDOW_MODE = os.getenv("LLAMAGUARD_WINDOW_MODE", "sentence")
+LLAMAGUARD_WINDOW_TOKENS = int(os.getenv("LLAMAGUARD_WINDOW_TOKENS", "32"))
+
+SPECULATIVE_INPUT_MODERATION = (
+    os.getenv("SPECULATIVE_INPUT_MODERATION", "false").lower() == "true"
+)
+
+# Handlers are async, so a battle no longer pins a worker thread while it streams.
+QUEUE_CONCURRENCY_LIMIT = int(os.getenv("QUEUE_CONCURRENCY_LIMIT", "200"))
+
+STARTUP_WARMUP = os.getenv("STARTUP_WARMUP", "true").lower() == "true"
+
+# How moderated responses are streamed back: instant | chunks | rate
+REPLAY_MODE = os.getenv("REPLAY_MODE", "chunks")
+REPLAY_CHUNK_SIZE = int(os.getenv("REPLAY_CHUNK_SIZE", "24"))
+REPLAY_CHARS_PER_SECOND = float(os.getenv("REPLAY_CHARS_PER_SECOND", "600"))
+
+VERDICT_CACHE_SIZE = int(os.getenv("VERDICT_CACHE_SIZE", "10000"))
+VERDICT_CACHE_TTL = float(os.getenv("VERDICT_CACHE_TTL", "86400"))
+# Set to a file path to keep verdicts across restarts.
+VERDICT_CACHE_PATH = os.getenv("VERDICT_CACHE_PATH")
+
+LLAMAGUARD_BATCHING = os.getenv("LLAMAGUARD_BATCHING", "false").lower() == "true"
+LLAMAGUARD_BATCH_MAX_SIZE = int(os.getenv("LLAMAGUARD_BATCH_MAX_SIZE", "16"))
+LLAMAGUARD_BATCH_MAX_WAIT_MS = float(os.getenv("LLAMAGUARD_BATCH_MAX_WAIT_MS", "10"))
+
+# Local input prefilter for the guarded models: off | shadow | enforce
+PREFILTER_MODE = os.getenv("PREFILTER_MODE", "shadow")
+PREFILTER_PATTERNS_PATH = os.getenv(
+    "PREFILTER_PATTERNS_PATH", "./prefilter_patterns.txt"
+)
+
+# Conversation windowing: drop_middle | last_turns | summarize
+HISTORY_POLICY = os.getenv("HISTORY_POLICY", "drop_middle")
+HISTORY_MAX_TURNS = int(os.getenv("HISTORY_MAX_TURNS", "10"))
+# Caps every model's prompt below its context window when set (0 = no cap).
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "0"))
+HISTORY_SUMMARY_TOKENS = int(os.getenv("HISTORY_SUMMARY_TOKENS", "256"))
+
+# Daily spend caps in USD per arena model name, as JSON, e.g. {"Gemini-Pro": 5}.
+METERING_DAILY_BUDGETS = json.loads(os.getenv("METERING_DAILY_BUDGETS", "{}"))
+METERING_DEFAULT_DAILY_BUDGET = float(os.getenv("METERING_DEFAULT_DAILY_BUDGET", "0"))
+# Share of a budget after which a model is picked less often and gets fewer
+# max output tokens, until it is no longer picked at 100%.
+METERING_SOFT_LIMIT = float(os.getenv("METERING_SOFT_LIMIT", "0.8"))
+# Set to a file path to append usage as JSON lines.
+METERING_PATH = os.getenv("METERING_PATH")
+METERING_FLUSH_INTERVAL = float(os.getenv("METERING_FLUSH_INTERVAL", "60"))
+
+# Stream the NeMo Guardrails models, checking the output rails per window.
+NEMO_STREAMING = os.getenv("NEMO_STREAMING", "false").lower() == "true"
+NEMO_WINDOW_MODE = os.getenv("NEMO_WINDOW_MODE", "sentence")
+NEMO_WINDOW_TOKENS = int(os.getenv("NEMO_WINDOW_TOKENS", "32"))
+
+# Presidio sensitive data detection for the NeMo models runs in this many
+# worker processes (0 = a thread in the app process).
+SDD_POOL_SIZE = int(os.getenv("SDD_POOL_SIZE", "2"))
+# en_core_web_lg as in NeMo Guardrails; en_core_web_md or _sm trade some recall
+# of names and places for memory and speed.
+SDD_SPACY_MODEL = os.getenv("SDD_SPACY_MODEL", "en_core_web_lg")
+SDD_BATCH_MAX_SIZE = int(os.getenv("SDD_BATCH_MAX_SIZE", "8"))
+SDD_BATCH_MAX_WAIT_MS = float(os.getenv("SDD_BATCH_MAX_WAIT_MS", "5"))
+
+# Upstream calls of a turn share one deadline for its first message, and then
+# each further message has to follow within STREAM_IDLE_SECONDS, so that long
+# answers are not cut off. Retries and hedged requests draw from a budget of
+# RETRY_BUDGET_RATIO of all requests.
+TURN_DEADLINE_SECONDS = float(os.getenv("TURN_DEADLINE_SECONDS", "120"))
+STREAM_IDLE_SECONDS = float(os.getenv("STREAM_IDLE_SECONDS", "30"))
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", "3"))
+RETRY_BUDGET_RATIO = float(os.getenv("RETRY_BUDGET_RATIO", "0.1"))
+# Tokens the budget holds when idle: by default one retry for RETRY_BUDGET_RATIO
+# of the model calls of as many battles as the queue runs at once.
+RETRY_BUDGET_BURST = float(
+    os.getenv(
+        "RETRY_BUDGET_BURST",
+        str(max(10, 2 * QUEUE_CONCURRENCY_LIMIT * RETRY_BUDGET_RATIO)),
+    )
+)
+# Send a duplicate request when the first token is later than this
+# percentile of the model's recent first-token latencies.
+HEDGING = os.getenv("HEDGING", "true").lower() == "true"
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "95"))
+# SDK retries for the NeMo Guardrails calls, which are not hedged.
+UPSTREAM_MAX_RETRIES = int(os.getenv("UPSTREAM_MAX_RETRIES", "2"))
+
+# The chat panes are updated at most every STREAM_FRAME_INTERVAL_MS, or as
+# soon as STREAM_FRAME_MIN_CHARS new characters arrived (0 = never early).
+STREAM_FRAME_INTERVAL_MS = float(os.getenv("STREAM_FRAME_INTERVAL_MS", "33"))
+STREAM_FRAME_MIN_CHARS = int(os.getenv("STREAM_FRAME_MIN_CHARS", "0"))
+
+# Rounds kept in memory: the least recently used beyond SESSION_MAX_SIZE and
+# those idle for SESSION_TTL_SECONDS are dropped.
+SESSION_MAX_SIZE = int(os.getenv("SESSION_MAX_SIZE", "10000"))
+SESSION_TTL_SECONDS = float(os.getenv("SESSION_TTL_SECONDS", "7200"))
+
+# Conversations and votes are appended to a SQLite outbox, and sent to the
+# Lighthouz API from there by a background worker; writes to the same
+# conversation are merged while they wait. Failed writes are retried with
+# exponential backoff up to PERSISTENCE_MAX_BACKOFF_SECONDS for as long as
+# the API is down.
+OUTBOX_PATH = os.getenv("OUTBOX_PATH", "./outbox.sqlite3")
+OUTBOX_RETENTION = float(os.getenv("OUTBOX_RETENTION", "86400"))
+PERSISTENCE_CONCURRENCY = int(os.getenv("PERSISTENCE_CONCURRENCY", "4"))
+PERSISTENCE_BACKOFF_SECONDS = float(os.getenv("PERSISTENCE_BACKOFF_SECONDS", "0.5"))
+PERSISTENCE_MAX_BACKOFF_SECONDS = float(
+    os.getenv("PERSISTENCE_MAX_BACKOFF_SECONDS", "300")
+)
+PERSISTENCE_TIMEOUT = float(os.getenv("PERSISTENCE_TIMEOUT", "30"))
+# Send only the turns that changed, for an API that versions conversations.
+PERSISTENCE_DELTAS = os.getenv("PERSISTENCE_DELTAS", "false").lower() == "true"
+
+# Circuit breakers per arena model and provider, over a rolling window of
+# battles. A breaker opens at HEALTH_MAX_ERROR_RATE errors and timeouts or a
+# p95 time to first token above HEALTH_MAX_TTFT_SECONDS, and lets one probe
+# battle through after HEALTH_OPEN_SECONDS.
+HEALTH_WINDOW_SECONDS = float(os.getenv("HEALTH_WINDOW_SECONDS", "300"))
+HEALTH_MIN_CALLS = int(os.getenv("HEALTH_MIN_CALLS", "5"))
+HEALTH_MAX_ERROR_RATE = float(os.getenv("HEALTH_MAX_ERROR_RATE", "0.5"))
+HEALTH_MAX_TTFT_SECONDS = float(os.getenv("HEALTH_MAX_TTFT_SECONDS", "30"))
+HEALTH_OPEN_SECONDS = float(os.getenv("HEALTH_OPEN_SECONDS", "60"))
@@ -0,0 +1,112 @@
+import asyncio
+from collections import deque
+from typing import AsyncIterator, Callable, List, Optional
+
+_DONE = object()
+
+
+async def merge_streams(
+    *generators: AsyncIterator[str],
+    interval: float = 0.0,
+    min_chars: int = 0,
+    on_error: Optional[Callable[[int, Exception], str]] = None,
+) -> AsyncIterator[List[List[str]]]:
+    """Consume each generator in its own task and yield the chunks each one
+    produced since the last yield, so that a slow side never holds back the
+    other.
+
+    Chunks are coalesced into frames: the first chunk is yielded at once, and
+    later ones at most every `interval` seconds unless `min_chars` characters
+    are pending. Whatever is pending is yielded as soon as all generators are
+    done. An exception in a generator is raised here once the chunks before
+    it were yielded, unless `on_error(index, exception)` is given: then the
+    text it returns ends that generator's chunks and the others go on.
+    Closing this generator cancels the ones still running.
+    """
+    loop = asyncio.get_running_loop()
+    items = deque()
+    ready = asyncio.Event()
+
+    def put(item):
+        items.append(item)
+        ready.set()
+
+    async def pump(index: int, generator: AsyncIterator[str]):
+        try:
+            async for chunk in generator:
+                if chunk:
+                    put((index, chunk))
+        except Exception as e:
+            put((index, e))
+        else:
+            put((index, _DONE))
+
+    tasks = [
+        asyncio.ensure_future(pump(index, generator))
+        for index, generator in enumerate(generators)
+    ]
+    running = len(tasks)
+    chunks: List[List[str]] = [[] for _ in generators]
+    pending_chars = 0
+    last_frame = float("-inf")
+    error = None
+    try:
+        while running:
+            if not items:
+                timeout = None
+                if pending_chars:
+                    timeout = max(0.0, last_frame + interval - loop.time())
+                try:
+                    await asyncio.wait_for(ready.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                ready.clear()
+            while items:
+                index, item = items.popleft()
+                if item is _DONE:
+                    running -= 1
+                elif isinstance(item, Exception):
+                    running -= 1
+                    if on_error is None:
+                        error = error or item
+                    else:
+                        message = on_error(index, item)
+                        if message:
+                            chunks[index].append(message)
+                            pending_chars += len(message)
+                else:
+                    chunks[index].append(item)
+                    pending_chars += len(item)
+            now = loop.time()
+            if (
+                not running
+                or error is not None
+                or (pending_chars and now - last_frame >= interval)
+                or (min_chars and pending_chars >= min_chars)
+            ):
+                # The last frame also reports that all sides are done.
+                if pending_chars or not running:
+                    yield chunks
+                    chunks = [[] for _ in generators]
+                    pending_chars = 0
+                    last_frame = now
+                if error is not None:
+                    raise error
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+class ResponseBuffer:
+    """The text of a streamed response, joined once per frame from the chunks
+    that arrived since the previous one rather than from all of them."""
+
+    def __init__(self):
+        self.text = ""
+        self.frames = 0
+
+    def extend(self, chunks: List[str]) -> str:
+        self.text += "".join(chunks)
+        self.frames += 1
+        return self.text
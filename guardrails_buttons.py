@@ -4,6 +4,8 @@ import gradio as gr
 import requests
 
 from config import LIGHTHOUZ_API_URL
+from persistence import persistence_worker
+from sessions import get_session
 
 share_js = """
 function () {
@@ -102,45 +104,29 @@ def deactivate_invisible_vote_buttons():
     return leftvote_btn, rightvote_btn, tie_btn, bothbad_btn
 
 
-def leftvote(conversation_id, history1, history2):
-    try:
-        requests.put(
-            f"{LIGHTHOUZ_API_URL}/{conversation_id.value}",
-            json={"vote": 0, "conversations": [history1.value, history2.value]},
-        )
-    except Exception as e:
-        pass
+def send_vote(session_id, vote):
+    session = get_session(session_id)
+    body = {"vote": vote}
+    # Queued or stored after the last turn, unless storing it failed.
+    if not session.persisted:
+        body["conversations"] = [list(history) for history in session.histories]
+    persistence_worker.submit(session, body)
 
 
-def rightvote(conversation_id, history1, history2):
-    try:
-        requests.put(
-            f"{LIGHTHOUZ_API_URL}/{conversation_id.value}",
-            json={"vote": 1, "conversations": [history1.value, history2.value]},
-        )
-    except Exception as e:
-        pass
+def leftvote(session_id):
+    send_vote(session_id, 0)
 
 
-def tievote(conversation_id, history1, history2):
-    try:
-        requests.put(
-            f"{LIGHTHOUZ_API_URL}/{conversation_id.value}",
-            json={"vote": -1, "conversations": [history1.value, history2.value]},
-        )
-    except Exception as e:
-        pass
+def rightvote(session_id):
+    send_vote(session_id, 1)
 
 
-def bothbadvote(conversation_id, history1, history2):
-    try:
-        requests.put(
-            f"{LIGHTHOUZ_API_URL}/{conversation_id.value}",
-            json={"vote": None, "conversations": [history1.value, history2.value]},
-        )
-    except Exception as e:
-        print(e)
-        pass
+def tievote(session_id):
+    send_vote(session_id, -1)
+
+
+def bothbadvote(session_id):
+    send_vote(session_id, None)
 
 
 def get_rankings():
@@ -170,7 +156,8 @@ def get_rankings():
         return ""
 
 
-def show_models_fn(models):
+def show_models_fn(session_id):
+    models = get_session(session_id).llms
     model_1 = gr.Markdown(" 🅰️ " + models[0]["name"])
     model_2 = gr.Markdown(" 🅱️ " + models[1]["name"])
     return model_1, model_2
@@ -1,133 +1,164 @@
-import os
+import asyncio
 import random
-from typing import List, Optional
-
-import openai
-from google.generativeai.types import (
-    BlockedPromptException,
-    HarmBlockThreshold,
-    HarmCategory,
-    StopCandidateException,
-)
-from langchain_community.chat_models import ChatAnyscale
+from typing import AsyncIterator, Callable, List, Optional
+
 from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
-from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain_openai import ChatOpenAI
-from nemoguardrails import LLMRails, RailsConfig
+
+from clients import clients
+from config import (
+    LLAMAGUARD_STREAMING,
+    NEMO_STREAMING,
+    SPECULATIVE_INPUT_MODERATION,
+    UPSTREAM_MAX_RETRIES,
+)
 
 # from guardrails_ai_guard import guardrails_ai_moderate
+from health import health_tracker, monitored
+from hedging import hedger, with_deadline, within_deadline
+from history import count_tokens, history_manager
 from llamaguard_moderator import moderate_query, moderate_response
+from metering import meter, metered
+from metrics import instrumented
+from nemo_streaming import NEMO_REFUSAL, stream_rails
+from prefilter import prefilter
+from rails_pool import rails_pool
+from replay import replay
+from speculative_moderation import InputBlocked, speculative_stream
+from streaming_moderation import moderate_stream
+
+
+async def _completion_chunks(client, **kwargs) -> AsyncIterator[str]:
+    response = await client.chat.completions.create(stream=True, **kwargs)
+    completion = []
+    usage = None
+    try:
+        async for chunk in response:
+            # Some endpoints report usage on the last chunk.
+            usage = getattr(chunk, "usage", None) or usage
+            if chunk.choices and chunk.choices[0].delta.content is not None:
+                completion.append(chunk.choices[0].delta.content)
+                yield chunk.choices[0].delta.content
+    finally:
+        await response.close()
+        if usage is not None:
+            meter.record(kwargs["model"], usage.prompt_tokens, usage.completion_tokens)
+        else:
+            meter.record(
+                kwargs["model"],
+                sum(count_tokens(message["content"]) for message in kwargs["messages"]),
+                count_tokens("".join(completion)),
+            )
+
+
+def _langchain_messages(messages: List[dict]):
+    types = {"system": SystemMessage, "user": HumanMessage, "assistant": AIMessage}
+    return [types[message["role"]](message["content"]) for message in messages]
+
+
+async def _langchain_chunks(llm, messages) -> AsyncIterator[str]:
+    async for message in llm.astream(messages):
+        yield message.content
+
+
+# The direct upstream streams, retried and hedged per upstream model.
+
 
+async def _stream_completion(client, **kwargs) -> AsyncIterator[str]:
+    async for chunk in hedger.stream(
+        kwargs["model"], lambda: _completion_chunks(client, **kwargs)
+    ):
+        yield chunk
 
-def gpt35_turbo(
+
+async def _stream_langchain(llm, messages) -> AsyncIterator[str]:
+    model = getattr(llm, "model_name", None) or getattr(llm, "model", "unknown")
+    async for chunk in hedger.stream(model, lambda: _langchain_chunks(llm, messages)):
+        yield chunk
+
+
+async def gpt35_turbo(
     history: List[List[Optional[str]]],
     system_prompt: str,
     temperature: float = 1,
     top_p: float = 0.9,
     max_output_tokens: int = 2048,
 ):
-    llm = ChatOpenAI(
-        temperature=temperature,
-        max_retries=6,
-        model_name="gpt-3.5-turbo-1106",
-        metadata={"top_p": top_p, "max_output_tokens": max_output_tokens},
+    llm = clients.chat_openai(
+        "gpt-3.5-turbo-1106", temperature, top_p, max_output_tokens
+    )
+    history_langchain_format = _langchain_messages(
+        history_manager.build(
+            history, system_prompt, "gpt-3.5-turbo-1106", max_output_tokens
+        )
     )
-    history_langchain_format = []
-    history_langchain_format.append(SystemMessage(system_prompt))
-    for human, ai in history:
-        history_langchain_format.append(HumanMessage(human))
-        if ai:
-            history_langchain_format.append(AIMessage(ai))
-
-    ai_message = llm.stream(history_langchain_format)
-    for message in ai_message:
-        yield message.content
+
+    async for message in _stream_langchain(llm, history_langchain_format):
+        yield message
 
 
-def llama70B(
+async def llama70B(
     history: List[List[Optional[str]]],
     system_prompt: str,
     temperature: float = 1,
     top_p: float = 0.9,
     max_output_tokens: int = 2048,
 ):
-    client = openai.OpenAI(
-        base_url="https://api.endpoints.anyscale.com/v1",
-        api_key=os.environ.get("ANYSCALE_API_KEY"),
+    client = clients.anyscale()
+    messages = history_manager.build(
+        history, system_prompt, "meta-llama/Llama-2-70b-chat-hf", max_output_tokens
     )
-    messages = []
-    messages.append({"role": "system", "content": system_prompt})
-    for human, ai in history:
-        messages.append({"role": "user", "content": human})
-        if ai:
-            messages.append({"role": "assistant", "content": ai})
-    response = client.chat.completions.create(
+    async for message in _stream_completion(
+        client,
         model="meta-llama/Llama-2-70b-chat-hf",
         messages=messages,
         temperature=temperature,
         top_p=top_p,
         max_tokens=max_output_tokens,
-        stream=True,
-    )
-    for chunk in response:
-        if chunk.choices[0].delta.content is not None:
-            yield chunk.choices[0].delta.content
+    ):
+        yield message
 
 
-def mixtral7x8(
+async def mixtral7x8(
     history: List[List[Optional[str]]],
     system_prompt: str,
     temperature: float = 1,
     top_p: float = 0.9,
     max_output_tokens: int = 2048,
 ):
-    client = openai.OpenAI(
-        base_url="https://api.endpoints.anyscale.com/v1",
-        api_key=os.environ.get("ANYSCALE_API_KEY"),
+    client = clients.anyscale()
+    messages = history_manager.build(
+        history,
+        system_prompt,
+        "mistralai/Mixtral-8x7B-Instruct-v0.1",
+        max_output_tokens,
     )
-    messages = []
-    messages.append({"role": "system", "content": system_prompt})
-    for human, ai in history:
-        messages.append({"role": "user", "content": human})
-        if ai:
-            messages.append({"role": "assistant", "content": ai})
-    response = client.chat.completions.create(
+    async for message in _stream_completion(
+        client,
         model="mistralai/Mixtral-8x7B-Instruct-v0.1",
         messages=messages,
         temperature=temperature,
         top_p=top_p,
         max_tokens=max_output_tokens,
-        stream=True,
-    )
-    for chunk in response:
-        if chunk.choices[0].delta.content is not None:
-            yield chunk.choices[0].delta.content
+    ):
+        yield message
 
 
-def gemini_pro(
+async def gemini_pro(
     history: List[List[Optional[str]]],
     system_prompt: str,
     temperature: float = 1,
     top_p: float = 0.9,
     max_output_tokens: int = 2048,
 ):
-    llm = ChatGoogleGenerativeAI(
-        model="gemini-pro",
-        convert_system_message_to_human=True,
-        temperature=temperature,
-        max_retries=6,
-        metadata={"top_p": top_p, "max_output_tokens": max_output_tokens},
+    from google.generativeai.types import BlockedPromptException, StopCandidateException
+
+    llm = clients.chat_gemini(temperature, top_p, max_output_tokens)
+    history_langchain_format = _langchain_messages(
+        history_manager.build(history, system_prompt, "gemini-pro", max_output_tokens)
     )
-    history_langchain_format = []
-    history_langchain_format.append(SystemMessage(system_prompt))
-    for human, ai in history:
-        history_langchain_format.append(HumanMessage(human))
-        if ai:
-            history_langchain_format.append(AIMessage(ai))
     try:
-        ai_message = llm.stream(history_langchain_format)
-        for message in ai_message:
-            yield message.content
+        async for message in _stream_langchain(llm, history_langchain_format):
+            yield message
     except BlockedPromptException:
         yield "⚠️ I'm sorry, I cannot respond to that. (The input was blocked by the LLM)"
     except StopCandidateException:
@@ -137,328 +168,360 @@ def gemini_pro(
 ### LLAMA GUARD ###
 
 
-def gpt35_turbo_llamaguard(
+async def _moderated_output(query: str, chunks: AsyncIterator[str]):
+    if LLAMAGUARD_STREAMING:
+        async for message in moderate_stream(query, chunks):
+            yield message
+        return
+    response = "".join([chunk async for chunk in chunks])
+    if not await moderate_response(query=query, response=response):
+        yield "⚠️ I'm sorry, I cannot respond to that. (The output was blocked by the guardrail)"
+    else:
+        async for message in replay(response):
+            yield message
+
+
+async def _llamaguard(query: str, start_stream: Callable[[], AsyncIterator[str]]):
+    if prefilter.blocks(query):
+        yield "⚠️ I'm sorry, I cannot respond to that. (The input was blocked by the guardrail)"
+        return
+    if SPECULATIVE_INPUT_MODERATION:
+        chunks = speculative_stream(query, start_stream)
+    elif not await moderate_query(query):
+        yield "⚠️ I'm sorry, I cannot respond to that. (The input was blocked by the guardrail)"
+        return
+    else:
+        chunks = start_stream()
+    try:
+        async for message in _moderated_output(query, chunks):
+            yield message
+    except InputBlocked:
+        yield "⚠️ I'm sorry, I cannot respond to that. (The input was blocked by the guardrail)"
+
+
+async def gpt35_turbo_llamaguard(
     history: List[List[Optional[str]]],
     system_prompt: str,
     temperature: float = 1,
     top_p: float = 0.9,
     max_output_tokens: int = 2048,
 ):
-    if not moderate_query(history[-1][0]):
-        yield "⚠️ I'm sorry, I cannot respond to that. (The input was blocked by the guardrail)"
-    else:
-        llm = ChatOpenAI(
-            temperature=temperature,
-            max_retries=6,
-            model_name="gpt-3.5-turbo-1106",
-            metadata={"top_p": top_p, "max_output_tokens": max_output_tokens},
+    llm = clients.chat_openai(
+        "gpt-3.5-turbo-1106", temperature, top_p, max_output_tokens
+    )
+    history_langchain_format = _langchain_messages(
+        history_manager.build(
+            history, system_prompt, "gpt-3.5-turbo-1106", max_output_tokens
         )
-        history_langchain_format = []
-        history_langchain_format.append(SystemMessage(system_prompt))
-        for human, ai in history:
-            history_langchain_format.append(HumanMessage(human))
-            if ai:
-                history_langchain_format.append(AIMessage(ai))
-
-        ai_message = llm(history_langchain_format)
-        response = ai_message.content
-        if not moderate_response(query=history[-1][0], response=response):
-            yield "⚠️ I'm sorry, I cannot respond to that. (The output was blocked by the guardrail)"
-        else:
-            for message in response:
-                yield message
+    )
 
+    async for message in _llamaguard(
+        history[-1][0],
+        lambda: _stream_langchain(llm, history_langchain_format),
+    ):
+        yield message
 
-def llama70B_llamaguard(
+
+async def llama70B_llamaguard(
     history: List[List[Optional[str]]],
     system_prompt: str,
     temperature: float = 1,
     top_p: float = 0.9,
     max_output_tokens: int = 2048,
 ):
-    if not moderate_query(history[-1][0]):
-        yield "⚠️ I'm sorry, I cannot respond to that. (The input was blocked by the guardrail)"
-    else:
-        client = openai.OpenAI(
-            base_url="https://api.endpoints.anyscale.com/v1",
-            api_key=os.environ.get("ANYSCALE_API_KEY"),
-        )
-        messages = []
-        messages.append({"role": "system", "content": system_prompt})
-        for human, ai in history:
-            messages.append({"role": "user", "content": human})
-            if ai:
-                messages.append({"role": "assistant", "content": ai})
-        response = client.chat.completions.create(
+    client = clients.anyscale()
+    messages = history_manager.build(
+        history, system_prompt, "meta-llama/Llama-2-70b-chat-hf", max_output_tokens
+    )
+    async for message in _llamaguard(
+        history[-1][0],
+        lambda: _stream_completion(
+            client,
             model="meta-llama/Llama-2-70b-chat-hf",
             messages=messages,
             temperature=temperature,
             top_p=top_p,
             max_tokens=max_output_tokens,
-        )
-        response = response.choices[0].message.content
-        if not moderate_response(query=history[-1][0], response=response):
-            yield "⚠️ I'm sorry, I cannot respond to that. (The output was blocked by the guardrail)"
-        else:
-            for message in response:
-                yield message
+        ),
+    ):
+        yield message
 
 
-def mixtral7x8_llamaguard(
+async def mixtral7x8_llamaguard(
     history: List[List[Optional[str]]],
     system_prompt: str,
     temperature: float = 1,
     top_p: float = 0.9,
     max_output_tokens: int = 2048,
 ):
-    if not moderate_query(history[-1][0]):
-        yield "⚠️ I'm sorry, I cannot respond to that. (The input was blocked by the guardrail)"
-    else:
-        client = openai.OpenAI(
-            base_url="https://api.endpoints.anyscale.com/v1",
-            api_key=os.environ.get("ANYSCALE_API_KEY"),
-        )
-        messages = []
-        messages.append({"role": "system", "content": system_prompt})
-        for human, ai in history:
-            messages.append({"role": "user", "content": human})
-            if ai:
-                messages.append({"role": "assistant", "content": ai})
-        response = client.chat.completions.create(
+    client = clients.anyscale()
+    messages = history_manager.build(
+        history,
+        system_prompt,
+        "mistralai/Mixtral-8x7B-Instruct-v0.1",
+        max_output_tokens,
+    )
+    async for message in _llamaguard(
+        history[-1][0],
+        lambda: _stream_completion(
+            client,
             model="mistralai/Mixtral-8x7B-Instruct-v0.1",
             messages=messages,
             temperature=temperature,
             top_p=top_p,
             max_tokens=max_output_tokens,
-        )
-        response = response.choices[0].message.content
-        if not moderate_response(query=history[-1][0], response=response):
-            yield "⚠️ I'm sorry, I cannot respond to that. (The output was blocked by the guardrail)"
-        else:
-            for message in response:
-                yield message
+        ),
+    ):
+        yield message
 
 
-def gemini_pro_llamaguard(
+async def gemini_pro_llamaguard(
     history: List[List[Optional[str]]],
     system_prompt: str,
     temperature: float = 1,
     top_p: float = 0.9,
     max_output_tokens: int = 2048,
 ):
-    if not moderate_query(history[-1][0]):
-        yield "⚠️ I'm sorry, I cannot respond to that. (The input was blocked by the guardrail)"
-    else:
-        llm = ChatGoogleGenerativeAI(
-            model="gemini-pro",
-            convert_system_message_to_human=True,
-            temperature=temperature,
-            max_retries=6,
-            metadata={"top_p": top_p, "max_output_tokens": max_output_tokens},
-        )
-        history_langchain_format = []
-        history_langchain_format.append(SystemMessage(system_prompt))
-        for human, ai in history:
-            history_langchain_format.append(HumanMessage(human))
-            if ai:
-                history_langchain_format.append(AIMessage(ai))
-        try:
-            ai_message = llm(history_langchain_format)
-            response = ai_message.content
-            if not moderate_response(query=history[-1][0], response=response):
-                yield "⚠️ I'm sorry, I cannot respond to that. (The output was blocked by the guardrail)"
-            else:
-                for message in response:
-                    yield message
-        except BlockedPromptException:
-            yield "⚠️ I'm sorry, I cannot respond to that. (The input was blocked by the LLM)"
-        except StopCandidateException:
-            yield "⚠️ I'm sorry, I cannot respond to that. (The output was blocked by the LLM)"
+    from google.generativeai.types import BlockedPromptException, StopCandidateException
+
+    llm = clients.chat_gemini(temperature, top_p, max_output_tokens)
+    history_langchain_format = _langchain_messages(
+        history_manager.build(history, system_prompt, "gemini-pro", max_output_tokens)
+    )
+    try:
+        async for message in _llamaguard(
+            history[-1][0],
+            lambda: _stream_langchain(llm, history_langchain_format),
+        ):
+            yield message
+    except BlockedPromptException:
+        yield "⚠️ I'm sorry, I cannot respond to that. (The input was blocked by the LLM)"
+    except StopCandidateException:
+        yield "⚠️ I'm sorry, I cannot respond to that. (The output was blocked by the LLM)"
 
 
 ### NeMo Guardrails ###
 
 
-def gpt35_turbo_nemoguardrails(
+async def _nemoguardrails(
+    query: str, messages: List[dict], key: tuple, llm_factory: Callable
+):
+    if prefilter.blocks(query):
+        yield NEMO_REFUSAL
+        return
+    async with rails_pool.acquire(key, llm_factory) as rails:
+        if NEMO_STREAMING:
+            async for message in stream_rails(rails, query, messages):
+                yield message
+            return
+        # In its own task, so the context variables NeMo Guardrails sets for
+        # the call (current task, explain info) do not leak into the handler.
+        completion = await within_deadline(
+            asyncio.ensure_future(rails.generate_async(messages=messages))
+        )
+    response = completion.get("content", "")
+    async for message in replay(response):
+        yield message
+
+
+async def gpt35_turbo_nemoguardrails(
     history: List[List[str]],
     system_prompt: str,
     temperature: float = 1,
     top_p: float = 0.9,
     max_output_tokens: int = 2048,
 ):
-    messages = []
-    messages.append({"role": "system", "content": system_prompt})
-    for human, ai in history:
-        messages.append({"role": "user", "content": human})
-        if ai:
-            messages.append({"role": "assistant", "content": ai})
-    config = RailsConfig.from_path("./nemoguardrails_config")
-    rails = LLMRails(
-        config,
-        llm=ChatOpenAI(
-            model_name="gpt-3.5-turbo-1106",
-            temperature=temperature,
-            max_retries=6,
-            metadata={"top_p": top_p, "max_output_tokens": max_output_tokens},
-        ),
+    messages = history_manager.build(
+        history, system_prompt, "gpt-3.5-turbo-1106", max_output_tokens
     )
-    completion = rails.generate(messages=messages)
-    response = completion.get("content", "")
-    for message in response:
+    async for message in _nemoguardrails(
+        history[-1][0],
+        messages,
+        ("gpt-3.5-turbo-1106", temperature, top_p, max_output_tokens),
+        lambda: clients.chat_openai(
+            "gpt-3.5-turbo-1106",
+            temperature,
+            top_p,
+            max_output_tokens,
+            streaming=NEMO_STREAMING,
+            max_retries=UPSTREAM_MAX_RETRIES,
+        ),
+    ):
         yield message
 
 
-def llama70B_nemoguardrails(
+async def llama70B_nemoguardrails(
     history: List[List[str]],
     system_prompt: str,
     temperature: float = 1,
     top_p: float = 0.9,
     max_output_tokens: int = 2048,
 ):
-    messages = []
-    messages.append({"role": "system", "content": system_prompt})
-    for human, ai in history:
-        messages.append({"role": "user", "content": human})
-        if ai:
-            messages.append({"role": "assistant", "content": ai})
-    config = RailsConfig.from_path("./nemoguardrails_config")
-    rails = LLMRails(
-        config,
-        llm=ChatAnyscale(
-            model="meta-llama/Llama-2-70b-chat-hf",
-            temperature=temperature,
-            max_retries=6,
-            metadata={"top_p": top_p, "max_output_tokens": max_output_tokens},
-        ),
+    messages = history_manager.build(
+        history, system_prompt, "meta-llama/Llama-2-70b-chat-hf", max_output_tokens
     )
-    completion = rails.generate(messages=messages)
-    response = completion.get("content", "")
-    for message in response:
+    async for message in _nemoguardrails(
+        history[-1][0],
+        messages,
+        ("meta-llama/Llama-2-70b-chat-hf", temperature, top_p, max_output_tokens),
+        lambda: clients.chat_anyscale(
+            "meta-llama/Llama-2-70b-chat-hf",
+            temperature,
+            top_p,
+            max_output_tokens,
+            streaming=NEMO_STREAMING,
+            max_retries=UPSTREAM_MAX_RETRIES,
+        ),
+    ):
         yield message
 
 
-def mixtral7x8_nemoguardrails(
+async def mixtral7x8_nemoguardrails(
     history: List[List[str]],
     system_prompt: str,
     temperature: float = 1,
     top_p: float = 0.9,
     max_output_tokens: int = 2048,
 ):
-    messages = []
-    messages.append({"role": "system", "content": system_prompt})
-    for human, ai in history:
-        messages.append({"role": "user", "content": human})
-        if ai:
-            messages.append({"role": "assistant", "content": ai})
-    config = RailsConfig.from_path("./nemoguardrails_config")
-    rails = LLMRails(
-        config,
-        llm=ChatAnyscale(
-            model="mistralai/Mixtral-8x7B-Instruct-v0.1",
-            temperature=temperature,
-            max_retries=6,
-            metadata={"top_p": top_p, "max_output_tokens": max_output_tokens},
-        ),
+    messages = history_manager.build(
+        history,
+        system_prompt,
+        "mistralai/Mixtral-8x7B-Instruct-v0.1",
+        max_output_tokens,
     )
-    completion = rails.generate(messages=messages)
-    response = completion.get("content", "")
-    for message in response:
+    async for message in _nemoguardrails(
+        history[-1][0],
+        messages,
+        ("mistralai/Mixtral-8x7B-Instruct-v0.1", temperature, top_p, max_output_tokens),
+        lambda: clients.chat_anyscale(
+            "mistralai/Mixtral-8x7B-Instruct-v0.1",
+            temperature,
+            top_p,
+            max_output_tokens,
+            streaming=NEMO_STREAMING,
+            max_retries=UPSTREAM_MAX_RETRIES,
+        ),
+    ):
         yield message
 
 
-def gemini_pro_nemoguardrails(
+async def gemini_pro_nemoguardrails(
     history: List[List[str]],
     system_prompt: str,
     temperature: float = 1,
     top_p: float = 0.9,
     max_output_tokens: int = 2048,
 ):
-    messages = []
-    messages.append({"role": "system", "content": system_prompt})
-    for human, ai in history:
-        messages.append({"role": "user", "content": human})
-        if ai:
-            messages.append({"role": "assistant", "content": ai})
-    config = RailsConfig.from_path("./nemoguardrails_config")
-    rails = LLMRails(
-        config,
-        llm=ChatGoogleGenerativeAI(
-            model="gemini-pro",
-            convert_system_message_to_human=True,
-            temperature=temperature,
-            max_retries=6,
-            metadata={"top_p": top_p, "max_output_tokens": max_output_tokens},
-            safety_settings={
-                HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
-                HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_NONE,
-                HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
-                HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
-            },
-        ),
+    messages = history_manager.build(
+        history, system_prompt, "gemini-pro", max_output_tokens
     )
-    completion = rails.generate(messages=messages)
-    response = completion.get("content", "")
-    for message in response:
+    async for message in _nemoguardrails(
+        history[-1][0],
+        messages,
+        ("gemini-pro", temperature, top_p, max_output_tokens),
+        lambda: clients.chat_gemini(
+            temperature,
+            top_p,
+            max_output_tokens,
+            block_none=True,
+            max_retries=UPSTREAM_MAX_RETRIES,
+        ),
+    ):
         yield message
 
 
 def get_all_models():
-    return [
+    models = [
         {
             "name": "gpt3.5-turbo-1106",
+            "provider": "openai",
             "model": gpt35_turbo,
         },
         {
             "name": "Llama-2-70b-chat-hf",
+            "provider": "anyscale",
             "model": llama70B,
         },
         {
             "name": "Mixtral-8x7B-Instruct-v0.1",
+            "provider": "anyscale",
             "model": mixtral7x8,
         },
         {
             "name": "Gemini-Pro",
+            "provider": "gemini",
             "model": gemini_pro,
         },
         {
             "name": "gpt3.5-turbo-1106 + Llama Guard",
+            "provider": "openai",
             "model": gpt35_turbo_llamaguard,
         },
         {
             "name": "Llama-2-70b-chat-hf + Llama Guard",
+            "provider": "anyscale",
             "model": llama70B_llamaguard,
         },
         {
             "name": "Mixtral-8x7B-Instruct-v0.1 + Llama Guard",
+            "provider": "anyscale",
             "model": mixtral7x8_llamaguard,
         },
         {
             "name": "Gemini-Pro + Llama Guard",
+            "provider": "gemini",
             "model": gemini_pro_llamaguard,
         },
         {
             "name": "gpt3.5-turbo-1106 + NeMo Guardrails",
+            "provider": "openai",
             "model": gpt35_turbo_nemoguardrails,
         },
         {
             "name": "Llama-2-70b-chat-hf + NeMo Guardrails",
+            "provider": "anyscale",
             "model": llama70B_nemoguardrails,
         },
         {
             "name": "Mixtral-8x7B-Instruct-v0.1 + NeMo Guardrails",
+            "provider": "anyscale",
             "model": mixtral7x8_nemoguardrails,
         },
         {
             "name": "Gemini-Pro + NeMo Guardrails",
+            "provider": "gemini",
             "model": gemini_pro_nemoguardrails,
         },
     ]
+    for model in models:
+        name = model["name"]
+        model["model"] = metered(
+            name,
+            with_deadline(
+                monitored(name, model["provider"], instrumented(name, model["model"]))
+            ),
+        )
+    return models
 
 
 def get_random_models(number: int = 2):
     models = get_all_models()
-    random.shuffle(models)
-    return models[:number]
+    # Models close to their daily budget are picked less often, and models
+    # whose circuit breaker is open are not picked while others are left.
+    weights = [
+        meter.throttle(model["name"])
+        * health_tracker.available(model["name"], model["provider"])
+        for model in models
+    ]
+    selected = []
+    while len(selected) < number and models:
+        if sum(weights) > 0:
+            index = random.choices(range(len(models)), weights)[0]
+        else:
+            index = random.randrange(len(models))
+        selected.append(models.pop(index))
+        weights.pop(index)
+    return selected
 
 
 def get_random_system_prompt():
@@ -0,0 +1,212 @@
+import functools
+import threading
+import time
+from collections import deque
+from typing import Deque, Dict, Optional, Tuple
+
+from config import (
+    HEALTH_MAX_ERROR_RATE,
+    HEALTH_MAX_TTFT_SECONDS,
+    HEALTH_MIN_CALLS,
+    HEALTH_OPEN_SECONDS,
+    HEALTH_WINDOW_SECONDS,
+    TURN_DEADLINE_SECONDS,
+)
+from hedging import DeadlineExceeded
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+OK = "ok"
+ERROR = "error"
+TIMEOUT = "timeout"
+
+
+def _percentile(values, percentile: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percentile / 100))]
+
+
+class CircuitBreaker:
+    """Closed while the battles of the last `window` seconds are healthy.
+
+    Opens when at least `min_calls` of them have an error and timeout rate of
+    `max_error_rate` or a p95 time to first token above `max_ttft`. After
+    `open_seconds` it is half-open: one probe battle may be started (another
+    one if the probe has not reported back within `probe_timeout`), and the
+    next outcome closes the breaker or opens it again.
+    """
+
+    def __init__(
+        self,
+        window: float = HEALTH_WINDOW_SECONDS,
+        min_calls: int = HEALTH_MIN_CALLS,
+        max_error_rate: float = HEALTH_MAX_ERROR_RATE,
+        max_ttft: float = HEALTH_MAX_TTFT_SECONDS,
+        open_seconds: float = HEALTH_OPEN_SECONDS,
+        probe_timeout: float = TURN_DEADLINE_SECONDS,
+    ):
+        self.window = window
+        self.min_calls = max(1, min_calls)
+        self.max_error_rate = max_error_rate
+        self.max_ttft = max_ttft
+        self.open_seconds = open_seconds
+        self.probe_timeout = probe_timeout
+        # (time, outcome, time to first token)
+        self._outcomes: Deque[Tuple[float, str, Optional[float]]] = deque()
+        self.state = CLOSED
+        self._opened_at = 0.0
+        self._probe_started: Optional[float] = None
+        self.trips = 0
+
+    def _prune(self, now: float):
+        while self._outcomes and self._outcomes[0][0] < now - self.window:
+            self._outcomes.popleft()
+
+    def _open(self, now: float):
+        if self.state == CLOSED:
+            self.trips += 1
+        self.state = OPEN
+        self._opened_at = now
+        self._probe_started = None
+
+    def _healthy(self, outcome: str, ttft: Optional[float]) -> bool:
+        return outcome == OK and not (self.max_ttft and ttft and ttft > self.max_ttft)
+
+    def _unhealthy(self) -> bool:
+        if len(self._outcomes) < self.min_calls:
+            return False
+        failures = sum(outcome != OK for _, outcome, _ in self._outcomes)
+        if failures / len(self._outcomes) >= self.max_error_rate:
+            return True
+        ttft = _percentile([ttft for _, _, ttft in self._outcomes if ttft], 95)
+        return bool(self.max_ttft and ttft and ttft > self.max_ttft)
+
+    def record(self, outcome: str, ttft: Optional[float] = None):
+        now = time.monotonic()
+        self._outcomes.append((now, outcome, ttft))
+        self._prune(now)
+        if self.state == HALF_OPEN:
+            if self._healthy(outcome, ttft):
+                self.state = CLOSED
+                self._outcomes.clear()
+            else:
+                self._open(now)
+        elif self.state == CLOSED and self._unhealthy():
+            self._open(now)
+
+    def allows(self) -> bool:
+        now = time.monotonic()
+        if self.state == OPEN and now - self._opened_at >= self.open_seconds:
+            self.state = HALF_OPEN
+        if self.state == CLOSED:
+            return True
+        if self.state == HALF_OPEN:
+            return (
+                self._probe_started is None
+                or now - self._probe_started >= self.probe_timeout
+            )
+        return False
+
+    def selected(self):
+        if self.state == HALF_OPEN:
+            self._probe_started = time.monotonic()
+
+    def stats(self):
+        self._prune(time.monotonic())
+        outcomes = [outcome for _, outcome, _ in self._outcomes]
+        ttfts = [ttft for _, _, ttft in self._outcomes if ttft]
+        calls = len(outcomes)
+        return {
+            "state": self.state,
+            "calls": calls,
+            "error_rate": outcomes.count(ERROR) / calls if calls else 0.0,
+            "timeout_rate": outcomes.count(TIMEOUT) / calls if calls else 0.0,
+            "ttft_p50": _percentile(ttfts, 50),
+            "ttft_p95": _percentile(ttfts, 95),
+            "trips": self.trips,
+        }
+
+
+class HealthTracker:
+    """Circuit breakers per arena model (name from get_all_models()) and per
+    upstream provider; a model is picked for battles only while both of its
+    breakers allow it."""
+
+    def __init__(self, **breaker_kwargs):
+        self._breaker_kwargs = breaker_kwargs
+        self._lock = threading.Lock()
+        self._models: Dict[str, CircuitBreaker] = {}
+        self._providers: Dict[str, CircuitBreaker] = {}
+
+    def _breakers(self, model: str, provider: str):
+        if model not in self._models:
+            self._models[model] = CircuitBreaker(**self._breaker_kwargs)
+        if provider not in self._providers:
+            self._providers[provider] = CircuitBreaker(**self._breaker_kwargs)
+        return self._models[model], self._providers[provider]
+
+    def record(
+        self, model: str, provider: str, outcome: str, ttft: Optional[float] = None
+    ):
+        with self._lock:
+            for breaker in self._breakers(model, provider):
+                breaker.record(outcome, ttft)
+
+    def available(self, model: str, provider: str) -> bool:
+        with self._lock:
+            model_breaker, provider_breaker = self._breakers(model, provider)
+            return model_breaker.allows() and provider_breaker.allows()
+
+    def selected(self, model: str, provider: str):
+        with self._lock:
+            for breaker in self._breakers(model, provider):
+                breaker.selected()
+
+    def stats(self):
+        with self._lock:
+            models = {name: b.stats() for name, b in self._models.items()}
+            providers = {name: b.stats() for name, b in self._providers.items()}
+        healthy = all(
+            stats["state"] == CLOSED
+            for stats in list(models.values()) + list(providers.values())
+        )
+        return {
+            "status": "ok" if healthy else "degraded",
+            "models": models,
+            "providers": providers,
+        }
+
+
+health_tracker = HealthTracker()
+
+
+def monitored(name: str, provider: str, model):
+    """Wrap an arena model function so that the outcome and time to first
+    message of its battles feed the circuit breakers."""
+
+    @functools.wraps(model)
+    async def wrapper(*args, **kwargs):
+        started = time.monotonic()
+        ttft = None
+        generator = model(*args, **kwargs)
+        try:
+            async for message in generator:
+                if ttft is None:
+                    ttft = time.monotonic() - started
+                yield message
+        except DeadlineExceeded:
+            health_tracker.record(name, provider, TIMEOUT, ttft)
+            raise
+        except Exception:
+            health_tracker.record(name, provider, ERROR, ttft)
+            raise
+        else:
+            health_tracker.record(name, provider, OK, ttft)
+        finally:
+            await generator.aclose()
+
+    return wrapper
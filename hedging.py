@@ -0,0 +1,323 @@
+import asyncio
+import functools
+import random
+import time
+from collections import defaultdict, deque
+from contextvars import ContextVar
+from typing import AsyncIterator, Awaitable, Callable, Deque, Dict, Optional
+
+from config import (
+    HEDGE_PERCENTILE,
+    HEDGING,
+    RETRY_BUDGET_BURST,
+    RETRY_BUDGET_RATIO,
+    RETRY_MAX_ATTEMPTS,
+    STREAM_IDLE_SECONDS,
+    TURN_DEADLINE_SECONDS,
+)
+
+TIMEOUT_MESSAGE = "⚠️ I'm sorry, the model did not respond in time."
+
+RETRY_BACKOFF = 0.5
+RETRY_MAX_BACKOFF = 8.0
+# Hedge only once enough first-token latencies were seen for a model.
+HEDGE_MIN_SAMPLES = 20
+LATENCY_WINDOW = 200
+RETRYABLE_ERRORS = {
+    "APIConnectionError",
+    "APITimeoutError",
+    "RateLimitError",
+    "InternalServerError",
+    "ResourceExhausted",
+    "ServiceUnavailable",
+    "TooManyRequests",
+}
+
+# Monotonic time by which the current turn has to be answered.
+deadline_var: ContextVar[Optional[float]] = ContextVar("deadline", default=None)
+
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
+def remaining() -> Optional[float]:
+    deadline = deadline_var.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+async def within_deadline(awaitable: Awaitable):
+    left = remaining()
+    if left is None:
+        return await awaitable
+    try:
+        return await asyncio.wait_for(awaitable, max(left, 0))
+    except asyncio.TimeoutError:
+        raise DeadlineExceeded("The turn deadline passed") from None
+
+
+def is_retryable(error: BaseException) -> bool:
+    # openai errors carry status_code, google.api_core errors code.
+    status = getattr(error, "status_code", None) or getattr(error, "code", None)
+    if isinstance(status, int) and (status == 429 or status >= 500):
+        return True
+    return type(error).__name__ in RETRYABLE_ERRORS
+
+
+def retry_after(error: BaseException) -> Optional[float]:
+    """Seconds the Retry-After header of a failed openai call asks to wait."""
+    response = getattr(error, "response", None)
+    value = getattr(response, "headers", {}).get("retry-after")
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+class RetryBudget:
+    """Token bucket shared by every retry and hedge in the process: each
+    request adds `ratio` tokens and a retry or hedge takes one, so together
+    they stay under `ratio` of the traffic. `min_per_second` tokens are
+    added over time so that a quiet process can still retry, and up to
+    `max_balance` are kept for a burst of failures."""
+
+    def __init__(
+        self,
+        ratio: float = RETRY_BUDGET_RATIO,
+        min_per_second: float = 1.0,
+        max_balance: float = RETRY_BUDGET_BURST,
+    ):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.max_balance = max_balance
+        self._balance = max_balance
+        self._updated = time.monotonic()
+        self.exhausted = 0
+
+    def _refill(self):
+        now = time.monotonic()
+        self._balance = min(
+            self.max_balance,
+            self._balance + (now - self._updated) * self.min_per_second,
+        )
+        self._updated = now
+
+    def deposit(self):
+        self._refill()
+        self._balance = min(self.max_balance, self._balance + self.ratio)
+
+    def withdraw(self) -> bool:
+        self._refill()
+        if self._balance >= 1:
+            self._balance -= 1
+            return True
+        self.exhausted += 1
+        return False
+
+
+class Hedger:
+    """Retries and hedges upstream calls within the turn deadline.
+
+    A call that fails with a retryable error before producing anything is
+    retried with jittered exponential backoff, or after its Retry-After.
+    When the first token (or the response, for non-streaming calls) takes
+    longer than the model's `hedge_percentile` latency, a duplicate request
+    is sent and whichever answers first is used. Both draw from one shared
+    RetryBudget.
+    """
+
+    def __init__(
+        self,
+        hedging: bool = HEDGING,
+        hedge_percentile: float = HEDGE_PERCENTILE,
+        max_attempts: int = RETRY_MAX_ATTEMPTS,
+        budget: Optional[RetryBudget] = None,
+    ):
+        self.hedging = hedging
+        self.hedge_percentile = hedge_percentile
+        self.max_attempts = max(1, max_attempts)
+        self.budget = budget or RetryBudget()
+        self._latencies: Dict[str, Deque[float]] = defaultdict(
+            lambda: deque(maxlen=LATENCY_WINDOW)
+        )
+        self.requests = 0
+        self.retries = 0
+        self.hedges_fired = 0
+        self.hedges_won = 0
+        self.deadlines_exceeded = 0
+
+    def latency(self, key: str, percentile: float) -> Optional[float]:
+        samples = self._latencies.get(key)
+        if not samples or len(samples) < HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * percentile / 100))]
+
+    def _deadline_exceeded(self) -> DeadlineExceeded:
+        self.deadlines_exceeded += 1
+        return DeadlineExceeded("The turn deadline passed")
+
+    async def _race(self, key: str, attempt: Callable[[], Awaitable], discard=None):
+        hedge_delay = self.latency(key, self.hedge_percentile) if self.hedging else None
+        started = {asyncio.ensure_future(attempt()): time.monotonic()}
+        primary = next(iter(started))
+        pending = {primary}
+        try:
+            while True:
+                timeout = remaining()
+                if hedge_delay is not None:
+                    until_hedge = started[primary] + hedge_delay - time.monotonic()
+                    timeout = (
+                        until_hedge if timeout is None else min(timeout, until_hedge)
+                    )
+                done, pending = await asyncio.wait(
+                    pending,
+                    timeout=None if timeout is None else max(timeout, 0),
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                if not done:
+                    left = remaining()
+                    if left is not None and left <= 0:
+                        raise self._deadline_exceeded()
+                    hedge_delay = None
+                    if self.budget.withdraw():
+                        hedge = asyncio.ensure_future(attempt())
+                        started[hedge] = time.monotonic()
+                        pending.add(hedge)
+                        self.hedges_fired += 1
+                    continue
+                # Every exception is retrieved, also of the tasks that lost, so
+                # that asyncio does not log them as never retrieved.
+                errors = {task: task.exception() for task in done}
+                winner = next((task for task in done if errors[task] is None), None)
+                if winner is None:
+                    error = errors[next(iter(done))]
+                    # The other request may still get through.
+                    if pending and is_retryable(error):
+                        continue
+                    raise error
+                if winner is not primary:
+                    self.hedges_won += 1
+                self._latencies[key].append(time.monotonic() - started[winner])
+                for task in done:
+                    if task is not winner and discard and errors[task] is None:
+                        await discard(task.result())
+                return winner.result()
+        finally:
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    async def _hedged(self, key: str, attempt: Callable[[], Awaitable], discard=None):
+        self.requests += 1
+        self.budget.deposit()
+        attempts = 1
+        while True:
+            try:
+                return await self._race(key, attempt, discard)
+            except DeadlineExceeded:
+                raise
+            except Exception as e:
+                if not is_retryable(e) or attempts >= self.max_attempts:
+                    raise
+                delay = min(RETRY_MAX_BACKOFF, RETRY_BACKOFF * 2 ** (attempts - 1))
+                delay *= random.uniform(0.5, 1)
+                delay = max(delay, retry_after(e) or 0)
+                left = remaining()
+                if left is not None and delay >= left:
+                    raise
+                if not self.budget.withdraw():
+                    raise
+                attempts += 1
+                self.retries += 1
+                await asyncio.sleep(delay)
+
+    async def call(self, key: str, start: Callable[[], Awaitable]):
+        """Await `start()`, retried and hedged on its total latency."""
+        return await self._hedged(key, start)
+
+    async def stream(
+        self, key: str, start: Callable[[], AsyncIterator[str]]
+    ) -> AsyncIterator[str]:
+        """Iterate `start()`, retried and hedged up to its first chunk."""
+
+        async def first_chunk():
+            chunks = start()
+            try:
+                return chunks, await chunks.__anext__()
+            except StopAsyncIteration:
+                return chunks, None
+            except BaseException:
+                await chunks.aclose()
+                raise
+
+        async def discard(result):
+            await result[0].aclose()
+
+        chunks, chunk = await self._hedged(key, first_chunk, discard)
+        try:
+            while chunk is not None:
+                yield chunk
+                try:
+                    chunk = await within_deadline(chunks.__anext__())
+                except StopAsyncIteration:
+                    chunk = None
+                except DeadlineExceeded:
+                    raise self._deadline_exceeded() from None
+        finally:
+            await chunks.aclose()
+
+    def stats(self):
+        return {
+            "requests": self.requests,
+            "retries": self.retries,
+            "hedges_fired": self.hedges_fired,
+            "hedges_won": self.hedges_won,
+            "budget_exhausted": self.budget.exhausted,
+            "deadlines_exceeded": self.deadlines_exceeded,
+            "hedge_after": {
+                key: self.latency(key, self.hedge_percentile) for key in self._latencies
+            },
+        }
+
+
+hedger = Hedger()
+
+
+def with_deadline(
+    model,
+    seconds: float = TURN_DEADLINE_SECONDS,
+    idle_seconds: float = STREAM_IDLE_SECONDS,
+):
+    """Wrap an arena model function so that its upstream calls share one
+    deadline for the first message of a turn, and each later message has to
+    follow within `idle_seconds` of the one before. A turn that runs out of
+    time ends with a notice."""
+
+    @functools.wraps(model)
+    async def wrapper(*args, **kwargs):
+        deadline = time.monotonic() + seconds
+        generator = model(*args, **kwargs)
+        try:
+            while True:
+                token = deadline_var.set(deadline)
+                timed_out = False
+                try:
+                    message = await generator.__anext__()
+                except StopAsyncIteration:
+                    return
+                except DeadlineExceeded:
+                    timed_out = True
+                finally:
+                    deadline_var.reset(token)
+                if timed_out:
+                    yield f"\n\n{TIMEOUT_MESSAGE}"
+                    return
+                yield message
+                deadline = time.monotonic() + idle_seconds
+        finally:
+            await generator.aclose()
+
+    return wrapper
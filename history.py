@@ -0,0 +1,191 @@
+import functools
+import re
+import threading
+from typing import List, Optional
+
+from config import (
+    HISTORY_MAX_TURNS,
+    HISTORY_POLICY,
+    HISTORY_SUMMARY_TOKENS,
+    HISTORY_TOKEN_BUDGET,
+)
+
+# Context windows of the arena models, in tokens.
+CONTEXT_WINDOWS = {
+    "gpt-3.5-turbo-1106": 16385,
+    "meta-llama/Llama-2-70b-chat-hf": 4096,
+    "mistralai/Mixtral-8x7B-Instruct-v0.1": 32768,
+    "gemini-pro": 30720,
+}
+DEFAULT_CONTEXT_WINDOW = 4096
+# Share of a model's window that cl100k_base counts may fill. Llama 2 and
+# Mixtral use 32k SentencePiece vocabularies that take 15-25% more tokens
+# than cl100k_base for the same text, and Gemini's tokenizer is not public.
+TOKEN_COUNT_RATIOS = {"gpt-3.5-turbo-1106": 1.0}
+DEFAULT_TOKEN_COUNT_RATIO = 0.8
+# Role markers and separators the chat templates add around every message.
+MESSAGE_OVERHEAD = 4
+SENTENCE = re.compile(r"\S.*?(?:[.!?](?=\s)|$)", re.S)
+
+_encoding = None
+_encoding_lock = threading.Lock()
+
+
+def _get_encoding():
+    global _encoding
+    with _encoding_lock:
+        if _encoding is None:
+            try:
+                import tiktoken
+
+                _encoding = tiktoken.get_encoding("cl100k_base")
+            except Exception as e:
+                # The BPE ranks are downloaded on first use; estimate offline.
+                print(f"Falling back to estimated token counts: {e}")
+                _encoding = False
+    return _encoding
+
+
+@functools.lru_cache(maxsize=4096)
+def count_tokens(text: str) -> int:
+    """Tokens in `text` plus the per-message overhead, cached per message.
+
+    cl100k_base is exact for GPT-3.5 only; it undercounts for the other
+    models, whose budgets are scaled by TOKEN_COUNT_RATIOS to make up for it.
+    """
+    encoding = _get_encoding()
+    if encoding:
+        return len(encoding.encode(text)) + MESSAGE_OVERHEAD
+    return len(text) // 3 + MESSAGE_OVERHEAD
+
+
+@functools.lru_cache(maxsize=256)
+def summarize(turns: tuple, max_tokens: int = HISTORY_SUMMARY_TOKENS) -> str:
+    """Extractive summary of dropped turns: the first sentence of each message,
+    oldest turns first, cut off at `max_tokens`."""
+    lines = []
+    used = 0
+    for human, ai in turns:
+        for role, content in (("User", human), ("Assistant", ai)):
+            if not content:
+                continue
+            match = SENTENCE.search(content)
+            line = f"{role}: {match.group().strip() if match else content.strip()}"
+            used += count_tokens(line)
+            if used > max_tokens:
+                return "\n".join(lines)
+            lines.append(line)
+    return "\n".join(lines)
+
+
+class HistoryManager:
+    """Builds the messages sent to a model from the chat history, within a
+    token budget derived from the model's context window.
+
+    Policies, applied to whole turns (a user message and its reply):
+    - "drop_middle" keeps the first turn and as many of the latest as fit.
+    - "last_turns" keeps at most the last `max_turns` turns that fit.
+    - "summarize" keeps the latest turns that fit and replaces the older
+      ones with a summary appended to the system prompt.
+    The current user message is always sent.
+    """
+
+    def __init__(
+        self,
+        policy: str = HISTORY_POLICY,
+        max_turns: int = HISTORY_MAX_TURNS,
+        token_budget: int = HISTORY_TOKEN_BUDGET,
+        summary_tokens: int = HISTORY_SUMMARY_TOKENS,
+    ):
+        if policy not in ("drop_middle", "last_turns", "summarize"):
+            raise ValueError(f"Unknown history policy: {policy}")
+        self.policy = policy
+        self.max_turns = max(1, max_turns)
+        self.token_budget = token_budget
+        self.summary_tokens = summary_tokens
+        self.windows = 0
+        self.trimmed = 0
+        self.dropped_turns = 0
+        self.summarized = 0
+
+    def budget(self, model: str, max_output_tokens: int) -> int:
+        """The prompt budget of `model` in count_tokens units."""
+        context = CONTEXT_WINDOWS.get(model, DEFAULT_CONTEXT_WINDOW)
+        budget = max(context - max_output_tokens, context // 4)
+        if self.token_budget:
+            budget = min(budget, self.token_budget)
+        return int(budget * TOKEN_COUNT_RATIOS.get(model, DEFAULT_TOKEN_COUNT_RATIO))
+
+    @staticmethod
+    def _turn_tokens(turn) -> int:
+        human, ai = turn
+        return count_tokens(human) + (count_tokens(ai) if ai else 0)
+
+    def _fit(self, turns: list, budget: int) -> int:
+        """Number of trailing turns that fit in `budget`, at least one."""
+        kept = 0
+        for turn in reversed(turns):
+            budget -= self._turn_tokens(turn)
+            if kept and budget < 0:
+                break
+            kept += 1
+        return kept
+
+    def build(
+        self,
+        history: List[List[Optional[str]]],
+        system_prompt: str,
+        model: str,
+        max_output_tokens: int,
+    ) -> List[dict]:
+        turns = [tuple(turn) for turn in history]
+        budget = self.budget(model, max_output_tokens) - count_tokens(system_prompt)
+        head, summary = [], ""
+        if self.policy == "last_turns":
+            tail = turns[-self.max_turns :]
+            tail = tail[len(tail) - self._fit(tail, budget) :]
+        elif self.policy == "drop_middle":
+            tail = turns[len(turns) - self._fit(turns, budget) :]
+            if len(tail) < len(turns):
+                # Keep the opening turn if it still fits next to the latest one.
+                rest = budget - self._turn_tokens(turns[0])
+                if rest >= self._turn_tokens(turns[-1]):
+                    head = turns[:1]
+                    tail = tail[len(tail) - self._fit(tail, rest) :]
+        else:
+            tail = turns[len(turns) - self._fit(turns, budget) :]
+            if len(tail) < len(turns):
+                budget -= self.summary_tokens
+                tail = tail[len(tail) - self._fit(tail, budget) :]
+                summary = summarize(
+                    tuple(turns[: len(turns) - len(tail)]), self.summary_tokens
+                )
+
+        self.windows += 1
+        dropped = len(turns) - len(head) - len(tail)
+        if dropped:
+            self.trimmed += 1
+            self.dropped_turns += dropped
+        if summary:
+            self.summarized += 1
+            system_prompt += f"\n\nSummary of the earlier conversation:\n{summary}"
+
+        messages = [{"role": "system", "content": system_prompt}]
+        for human, ai in head + tail:
+            messages.append({"role": "user", "content": human})
+            if ai:
+                messages.append({"role": "assistant", "content": ai})
+        return messages
+
+    def stats(self):
+        return {
+            "policy": self.policy,
+            "windows": self.windows,
+            "trimmed": self.trimmed,
+            "dropped_turns": self.dropped_turns,
+            "summarized": self.summarized,
+            "token_cache": count_tokens.cache_info()._asdict(),
+        }
+
+
+history_manager = HistoryManager()
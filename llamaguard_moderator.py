@@ -1,6 +1,13 @@
-import os
+from clients import clients
+from config import LLAMAGUARD_BATCHING
+from hedging import hedger
+from history import count_tokens
+from metering import arena_model_var, meter
+from metrics import guardrail_verdict_seconds
+from moderation_batcher import moderation_batcher
+from verdict_cache import verdict_cache
 
-import openai
+LLAMAGUARD_MODEL = "Meta-Llama/Llama-Guard-7b"
 
 unsafe_categories = """O1: Violence and Hate.
 Should not
@@ -134,35 +141,56 @@ def format_prompt(role, message):
     return prompt
 
 
-def moderate_query(prompt: str):
-    client = openai.OpenAI(
-        base_url=os.environ.get("ANYSCALE_BASE_URL"),
-        api_key=os.environ.get("ANYSCALE_API_KEY"),
-    )
-
-    completion = client.completions.create(
-        model="Meta-Llama/Llama-Guard-7b",
-        prompt=format_prompt("User", prompt),
-        temperature=0,
+async def _moderate(role: str, message: str) -> bool:
+    stage = "llamaguard_input" if role == "User" else "llamaguard_output"
+    with guardrail_verdict_seconds.time(model=arena_model_var.get(), guardrail=stage):
+        return await _verdict(role, message, stage)
+
+
+async def _verdict(role: str, message: str, stage: str) -> bool:
+    prompt = format_prompt(role, message)
+    if LLAMAGUARD_BATCHING:
+        moderator_response = await moderation_batcher.submit(prompt)
+        # Usage is reported per batch; estimate this prompt's share.
+        meter.record(
+            LLAMAGUARD_MODEL,
+            count_tokens(prompt),
+            count_tokens(moderator_response),
+            stage=stage,
+        )
+        return moderator_response.strip() == "safe"
+
+    client = clients.llamaguard()
+
+    completion = await hedger.call(
+        LLAMAGUARD_MODEL,
+        lambda: client.completions.create(
+            model=LLAMAGUARD_MODEL,
+            prompt=prompt,
+            temperature=0,
+        ),
     )
+    if completion.usage is not None:
+        meter.record(
+            LLAMAGUARD_MODEL,
+            completion.usage.prompt_tokens,
+            completion.usage.completion_tokens,
+            stage=stage,
+        )
     moderator_response = completion.choices[0].text.strip()
     if moderator_response == "safe":
         return True
     return False
 
 
-def moderate_response(query: str, response: str):
-    client = openai.OpenAI(
-        base_url=os.environ.get("ANYSCALE_BASE_URL"),
-        api_key=os.environ.get("ANYSCALE_API_KEY"),
+async def moderate_query(prompt: str):
+    return await verdict_cache.get_or_compute(
+        "User", prompt, lambda: _moderate("User", prompt)
     )
 
-    completion = client.completions.create(
-        model="Meta-Llama/Llama-Guard-7b",
-        prompt=format_prompt("Agent", f"User: {query}\n\nAgent: {response}"),
-        temperature=0,
+
+async def moderate_response(query: str, response: str):
+    message = f"User: {query}\n\nAgent: {response}"
+    return await verdict_cache.get_or_compute(
+        "Agent", message, lambda: _moderate("Agent", message)
     )
-    moderator_response = completion.choices[0].text.strip()
-    if moderator_response == "safe":
-        return True
-    return False
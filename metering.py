@@ -0,0 +1,285 @@
+import atexit
+import functools
+import json
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+from uuid import UUID
+
+from langchain_core.callbacks import AsyncCallbackHandler
+
+from config import (
+    METERING_DAILY_BUDGETS,
+    METERING_DEFAULT_DAILY_BUDGET,
+    METERING_FLUSH_INTERVAL,
+    METERING_PATH,
+    METERING_SOFT_LIMIT,
+)
+from history import count_tokens
+from metrics import guardrail_verdict_seconds
+
+# USD per million prompt and completion tokens, keyed by lowercased upstream model.
+PRICES = {
+    "gpt-3.5-turbo-1106": (1.0, 2.0),
+    "meta-llama/llama-2-70b-chat-hf": (1.0, 1.0),
+    "mistralai/mixtral-8x7b-instruct-v0.1": (0.5, 0.5),
+    "meta-llama/llama-guard-7b": (0.15, 0.15),
+    "gemini-pro": (0.5, 1.5),
+}
+MIN_OUTPUT_TOKENS = 64
+
+# The arena model (name from get_all_models()) and guardrail stage an upstream
+# call is made for. NeMo Guardrails tasks are picked up from its own context.
+arena_model_var: ContextVar[str] = ContextVar("arena_model", default="unknown")
+stage_var: ContextVar[str] = ContextVar("stage", default="generation")
+
+
+def price(model: str, prompt_tokens: int, completion_tokens: int) -> float:
+    model = model.lower()
+    if model.startswith("models/"):
+        model = model[len("models/") :]
+    prompt_price, completion_price = PRICES.get(model, (0.0, 0.0))
+    return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1e6
+
+
+def current_stage() -> str:
+    nemo_context = sys.modules.get("nemoguardrails.context")
+    if nemo_context is not None:
+        llm_call_info = nemo_context.llm_call_info_var.get()
+        if llm_call_info is not None and llm_call_info.task:
+            return llm_call_info.task
+    return stage_var.get()
+
+
+def _today() -> str:
+    return datetime.now(timezone.utc).date().isoformat()
+
+
+class Meter:
+    """Aggregates prompt/completion tokens and estimated cost of upstream
+    calls per arena model, guardrail stage and upstream model, and throttles
+    arena models as they approach their daily budget.
+
+    Totals are kept in memory for the current UTC day; when `path` is set,
+    the increments are appended to it as JSON lines every `flush_interval`
+    seconds and at exit.
+    """
+
+    def __init__(
+        self,
+        budgets: Dict[str, float] = METERING_DAILY_BUDGETS,
+        default_budget: float = METERING_DEFAULT_DAILY_BUDGET,
+        soft_limit: float = METERING_SOFT_LIMIT,
+        path: Optional[str] = METERING_PATH,
+        flush_interval: float = METERING_FLUSH_INTERVAL,
+    ):
+        self.budgets = budgets
+        self.default_budget = default_budget
+        self.soft_limit = min(soft_limit, 0.99)
+        self.path = path
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._day = _today()
+        self._totals = defaultdict(lambda: [0, 0, 0, 0.0])
+        self._unflushed = defaultdict(lambda: [0, 0, 0, 0.0])
+        self._spent = defaultdict(float)
+        self._flusher = None
+
+    def record(
+        self,
+        model: str,
+        prompt_tokens: int,
+        completion_tokens: int,
+        stage: Optional[str] = None,
+        arena_model: Optional[str] = None,
+    ):
+        arena_model = arena_model or arena_model_var.get()
+        key = (arena_model, stage or current_stage(), model)
+        cost = price(model, prompt_tokens, completion_tokens)
+        with self._lock:
+            day = _today()
+            if day != self._day:
+                self._day = day
+                self._totals.clear()
+                self._spent.clear()
+            for totals in (self._totals[key], self._unflushed[(day,) + key]):
+                totals[0] += 1
+                totals[1] += prompt_tokens
+                totals[2] += completion_tokens
+                totals[3] += cost
+            self._spent[arena_model] += cost
+            if self.path and self._flusher is None:
+                self._flusher = threading.Thread(
+                    target=self._flush_periodically, name="metering", daemon=True
+                )
+                self._flusher.start()
+                atexit.register(self.flush)
+
+    def _flush_periodically(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            rows, self._unflushed = self._unflushed, defaultdict(lambda: [0, 0, 0, 0.0])
+        if not rows or not self.path:
+            return
+        timestamp = datetime.now(timezone.utc).isoformat()
+        with open(self.path, "a") as f:
+            for (day, arena_model, stage, model), totals in rows.items():
+                calls, prompt_tokens, completion_tokens, cost = totals
+                row = {
+                    "timestamp": timestamp,
+                    "day": day,
+                    "arena_model": arena_model,
+                    "stage": stage,
+                    "model": model,
+                    "calls": calls,
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": completion_tokens,
+                    "cost": cost,
+                }
+                f.write(json.dumps(row) + "\n")
+
+    def daily_budget(self, arena_model: str) -> float:
+        return self.budgets.get(arena_model, self.default_budget)
+
+    def spent_today(self, arena_model: str) -> float:
+        with self._lock:
+            if self._day != _today():
+                return 0.0
+            return self._spent.get(arena_model, 0.0)
+
+    def throttle(self, arena_model: str) -> float:
+        """1.0 below the soft limit of the daily budget, falling linearly to
+        0.0 when the budget is used up."""
+        budget = self.daily_budget(arena_model)
+        if not budget:
+            return 1.0
+        used = self.spent_today(arena_model) / budget
+        if used <= self.soft_limit:
+            return 1.0
+        return max(0.0, (1 - used) / (1 - self.soft_limit))
+
+    def max_output_tokens(self, arena_model: str, requested: int) -> int:
+        throttle = self.throttle(arena_model)
+        if throttle >= 1.0:
+            return requested
+        return min(requested, max(MIN_OUTPUT_TOKENS, int(requested * throttle)))
+
+    def stats(self):
+        with self._lock:
+            models = defaultdict(lambda: {"calls": 0, "tokens": 0, "cost": 0.0})
+            stages = []
+            for (arena_model, stage, model), totals in self._totals.items():
+                calls, prompt_tokens, completion_tokens, cost = totals
+                models[arena_model]["calls"] += calls
+                models[arena_model]["tokens"] += prompt_tokens + completion_tokens
+                models[arena_model]["cost"] += cost
+                stages.append(
+                    {
+                        "arena_model": arena_model,
+                        "stage": stage,
+                        "model": model,
+                        "calls": calls,
+                        "prompt_tokens": prompt_tokens,
+                        "completion_tokens": completion_tokens,
+                        "cost": cost,
+                    }
+                )
+            day = self._day
+        for arena_model, totals in models.items():
+            totals["throttle"] = self.throttle(arena_model)
+        return {"day": day, "models": dict(models), "stages": stages}
+
+
+meter = Meter()
+
+
+class MeteringCallback(AsyncCallbackHandler):
+    """Records the LangChain chat model calls, including the ones NeMo
+    Guardrails makes for its own rails."""
+
+    def __init__(self):
+        self._runs: Dict[UUID, tuple] = {}
+
+    async def on_chat_model_start(
+        self, serialized, messages: List[list], *, run_id: UUID, **kwargs
+    ):
+        params = kwargs.get("invocation_params") or {}
+        model = params.get("model") or params.get("model_name") or "unknown"
+        prompt_tokens = sum(
+            count_tokens(str(message.content)) for message in messages[0]
+        )
+        self._runs[run_id] = (model, prompt_tokens, time.perf_counter())
+
+    async def on_llm_end(self, response, *, run_id: UUID, **kwargs):
+        run = self._runs.pop(run_id, None)
+        if run is None:
+            return
+        model, prompt_tokens, started = run
+        stage = current_stage()
+        if stage.startswith("self_check"):
+            # NeMo Guardrails' own rails run as LLM calls.
+            guardrail_verdict_seconds.observe(
+                time.perf_counter() - started,
+                model=arena_model_var.get(),
+                guardrail=stage,
+            )
+        usage = (response.llm_output or {}).get("token_usage") or {}
+        if usage.get("prompt_tokens") is not None:
+            prompt_tokens = usage["prompt_tokens"]
+        completion_tokens = usage.get("completion_tokens")
+        if completion_tokens is None:
+            completion_tokens = sum(
+                count_tokens(generation.text) for generation in response.generations[0]
+            )
+        meter.record(model, prompt_tokens, completion_tokens, stage=stage)
+
+    async def on_llm_error(self, error, *, run_id: UUID, **kwargs):
+        self._runs.pop(run_id, None)
+
+
+metering_callback = MeteringCallback()
+
+
+def metered(name: str, model):
+    """Wrap an arena model function so that its upstream calls are attributed
+    to `name` and its max output tokens follow the daily budget."""
+
+    @functools.wraps(model)
+    async def wrapper(
+        history,
+        system_prompt: str,
+        temperature: float = 1,
+        top_p: float = 0.9,
+        max_output_tokens: int = 2048,
+    ):
+        generator = model(
+            history,
+            system_prompt,
+            temperature,
+            top_p,
+            meter.max_output_tokens(name, max_output_tokens),
+        )
+        try:
+            while True:
+                # Set only while the model runs, not in the consumer between
+                # messages, so that nothing else is attributed to it.
+                token = arena_model_var.set(name)
+                try:
+                    message = await generator.__anext__()
+                except StopAsyncIteration:
+                    return
+                finally:
+                    arena_model_var.reset(token)
+                yield message
+        finally:
+            await generator.aclose()
+
+    return wrapper
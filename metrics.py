@@ -0,0 +1,385 @@
+import functools
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple, Union
+
+from history import count_tokens
+
+DEFAULT_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+INTER_TOKEN_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+TOKENS_PER_SECOND_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+FRAMES_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+# The endings of the refusals the model functions yield.
+BLOCKED_BY_GUARDRAIL = "blocked by the guardrail)"
+BLOCKED_BY_LLM = "blocked by the LLM)"
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [
+        '{}="{}"'.format(
+            name,
+            str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"),
+        )
+        for name, value in zip(names, values)
+    ]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        return "\n".join(lines + self._samples())
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[Tuple[str, ...], float] = defaultdict(float)
+
+    def inc(self, amount: float = 1, **labels):
+        with self._lock:
+            self._values[self._key(labels)] += amount
+
+    def _samples(self):
+        with self._lock:
+            values = dict(self._values)
+        return [
+            f"{self.name}_total{_format_labels(self.labelnames, key)} "
+            f"{_format_value(value)}"
+            for key, value in values.items()
+        ]
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[Tuple[str, ...], float] = defaultdict(float)
+
+    def inc(self, amount: float = 1, **labels):
+        with self._lock:
+            self._values[self._key(labels)] += amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    @contextmanager
+    def track(self, **labels):
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+    def _samples(self):
+        with self._lock:
+            values = dict(self._values) or {self._key({}): 0.0}
+        return [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+            for key, value in values.items()
+        ]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, *args, buckets: Sequence[float] = DEFAULT_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        # labels -> [count per bucket..., sum]
+        self._values: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            values = self._values.get(key)
+            if values is None:
+                values = self._values[key] = [0] * len(self.buckets) + [0.0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    values[index] += 1
+                    break
+            values[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def _samples(self):
+        with self._lock:
+            values = {key: list(counts) for key, counts in self._values.items()}
+        samples = []
+        for key, counts in values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                labels = _format_labels(
+                    self.labelnames, key, f'le="{_format_value(float(bound))}"'
+                )
+                samples.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            samples.append(f"{self.name}_sum{labels} {_format_value(counts[-1])}")
+            samples.append(f"{self.name}_count{labels} {cumulative}")
+        return samples
+
+
+def _is_number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+class StatsCollector:
+    """The numbers of a component's stats() dict, read when the registry is
+    rendered rather than copied into metrics as they change.
+
+    A number under the key path `a`, `b` becomes the gauge `{prefix}_a_b`,
+    or the counter `{prefix}_a_b_total` if "a_b" is in `counters`. The keys
+    of a dict whose path is in `labels` become values of that label instead
+    of parts of the name. Strings, lists and None are left out.
+    """
+
+    def __init__(
+        self,
+        prefix: str,
+        documentation: str,
+        stats: Callable[[], dict],
+        counters: Iterable[str] = (),
+        labels: Optional[Dict[str, str]] = None,
+    ):
+        self.name = prefix
+        self.documentation = documentation
+        self.stats = stats
+        self.counters = set(counters)
+        self.labels = labels or {}
+        registry.register(self)
+
+    def _flatten(self, path: Tuple[str, ...], value, labels: Dict[str, str]):
+        if _is_number(value):
+            yield "_".join(path), labels, value
+        elif isinstance(value, dict):
+            labelname = self.labels.get("_".join(path))
+            for key, item in value.items():
+                if labelname:
+                    yield from self._flatten(path, item, {**labels, labelname: key})
+                else:
+                    yield from self._flatten(path + (str(key),), item, labels)
+
+    def render(self) -> str:
+        families: Dict[str, List[Tuple[Dict[str, str], float]]] = defaultdict(list)
+        for key, labels, value in self._flatten((), self.stats(), {}):
+            families[key].append((labels, value))
+        lines = []
+        for key, samples in families.items():
+            name = f"{self.name}_{key}"
+            kind = "counter" if key in self.counters else "gauge"
+            lines.append(f"# HELP {name} {self.documentation}: {key}.")
+            lines.append(f"# TYPE {name} {kind}")
+            suffix = "_total" if kind == "counter" else ""
+            for labels, value in samples:
+                lines.append(
+                    f"{name}{suffix}{_format_labels(list(labels), list(labels.values()))}"
+                    f" {_format_value(value)}"
+                )
+        return "\n".join(lines)
+
+
+class Registry:
+    """The metrics of this process, rendered in the Prometheus text
+    exposition format."""
+
+    def __init__(self):
+        self._metrics: Dict[str, Union[_Metric, StatsCollector]] = {}
+
+    def register(self, metric: Union[_Metric, StatsCollector]):
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+
+    def render(self) -> str:
+        rendered = (metric.render() for metric in self._metrics.values())
+        return "\n".join(text for text in rendered if text) + "\n"
+
+
+registry = Registry()
+
+queue_wait_seconds = Histogram(
+    "arena_queue_wait_seconds",
+    "Time a battle waited in the Gradio queue.",
+    ["model"],
+)
+time_to_first_token_seconds = Histogram(
+    "arena_time_to_first_token_seconds",
+    "Time from the start of a model turn to its first message.",
+    ["model"],
+)
+inter_token_seconds = Histogram(
+    "arena_inter_token_seconds",
+    "Time between consecutive messages of a model turn.",
+    ["model"],
+    buckets=INTER_TOKEN_BUCKETS,
+)
+generation_seconds = Histogram(
+    "arena_generation_seconds",
+    "Total time of a model turn.",
+    ["model"],
+)
+output_tokens_per_second = Histogram(
+    "arena_output_tokens_per_second",
+    "Output tokens per second of a model turn after its first message.",
+    ["model"],
+    buckets=TOKENS_PER_SECOND_BUCKETS,
+)
+frames_per_response = Histogram(
+    "arena_frames_per_response",
+    "Chat pane updates sent while streaming a model turn.",
+    ["model"],
+    buckets=FRAMES_BUCKETS,
+)
+guardrail_verdict_seconds = Histogram(
+    "arena_guardrail_verdict_seconds",
+    "Time to get a guardrail verdict.",
+    ["model", "guardrail"],
+)
+persistence_seconds = Histogram(
+    "arena_persistence_seconds",
+    "Time of the Lighthouz API calls that store a battle.",
+    ["operation"],
+)
+persistence_queue_depth = Gauge(
+    "arena_persistence_queue_depth",
+    "Conversations with a write in flight to the Lighthouz API.",
+)
+persistence_writes = Counter(
+    "arena_persistence_writes",
+    "Writes to the Lighthouz API by outcome: ok, retried or failed, and "
+    "queue for those appended to the outbox.",
+    ["operation", "outcome"],
+)
+persistence_bytes = Counter(
+    "arena_persistence_bytes",
+    "Bytes of the request bodies sent to the Lighthouz API.",
+    ["operation"],
+)
+outbox_backlog = Gauge(
+    "arena_outbox_backlog",
+    "Writes in the outbox not yet accepted by the Lighthouz API.",
+)
+blocked = Counter(
+    "arena_blocked",
+    "Model turns that ended in a refusal, by what blocked them.",
+    ["model", "by"],
+)
+battles_in_flight = Gauge(
+    "arena_battles_in_flight",
+    "Battles currently being generated.",
+)
+
+
+def observe_queue_wait(request, model_names: Iterable[str]):
+    """Record the queue wait of a battle whose Gradio queue request was
+    stamped by QueueTimer."""
+    state = getattr(request, "state", None)
+    queued_at = getattr(state, "arena_queued_at", None)
+    if queued_at is None:
+        return
+    waited = time.monotonic() - queued_at
+    for name in model_names:
+        queue_wait_seconds.observe(waited, model=name)
+
+
+class QueueTimer:
+    """ASGI middleware that stamps the requests joining the Gradio queue with
+    the time they arrived, in the request state that Gradio hands on to the
+    handlers with the event. Gradio does not record it itself."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"].endswith("/queue/join"):
+            scope.setdefault("state", {})["arena_queued_at"] = time.monotonic()
+        await self.app(scope, receive, send)
+
+
+def instrumented(name: str, model):
+    """Wrap an arena model function to record the latency histograms and
+    refusals of its turns."""
+
+    @functools.wraps(model)
+    async def wrapper(*args, **kwargs):
+        started = last = time.monotonic()
+        first = None
+        response = []
+        generator = model(*args, **kwargs)
+        try:
+            async for message in generator:
+                now = time.monotonic()
+                if first is None:
+                    first = now
+                    time_to_first_token_seconds.observe(now - started, model=name)
+                else:
+                    inter_token_seconds.observe(now - last, model=name)
+                last = now
+                response.append(message)
+                yield message
+        finally:
+            await generator.aclose()
+        generation_seconds.observe(time.monotonic() - started, model=name)
+        text = "".join(response).rstrip()
+        if text.endswith(BLOCKED_BY_GUARDRAIL):
+            blocked.inc(model=name, by="guardrail")
+        elif text.endswith(BLOCKED_BY_LLM):
+            blocked.inc(model=name, by="llm")
+        elif first is not None and last > first:
+            output_tokens_per_second.observe(
+                count_tokens(text) / (last - first), model=name
+            )
+
+    return wrapper
+
+
+def metrics_endpoint():
+    from fastapi.responses import Response
+
+    return Response(registry.render(), media_type=CONTENT_TYPE)
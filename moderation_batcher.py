@@ -0,0 +1,89 @@
+import asyncio
+from typing import List, Optional, Tuple
+
+from clients import clients
+from config import LLAMAGUARD_BATCH_MAX_SIZE, LLAMAGUARD_BATCH_MAX_WAIT_MS
+from hedging import hedger
+
+
+class ModerationBatcher:
+    """Collects Llama Guard prompts from concurrent sessions and sends them as
+    one completions request with a list of prompts.
+
+    A batch is flushed when it reaches `max_size` prompts or `max_wait_ms`
+    after its first prompt arrived, whichever comes first.
+    """
+
+    def __init__(
+        self,
+        model: str = "Meta-Llama/Llama-Guard-7b",
+        max_size: int = LLAMAGUARD_BATCH_MAX_SIZE,
+        max_wait_ms: float = LLAMAGUARD_BATCH_MAX_WAIT_MS,
+    ):
+        self.model = model
+        self.max_size = max(1, max_size)
+        self.max_wait = max_wait_ms / 1000
+        self._pending: List[Tuple[str, asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._sending = set()
+        self.batches = 0
+        self.prompts = 0
+
+    async def submit(self, prompt: str) -> str:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((prompt, future))
+        if len(self._pending) >= self.max_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.ensure_future(self._send(batch))
+            self._sending.add(task)
+            task.add_done_callback(self._sending.discard)
+
+    async def _send(self, batch: List[Tuple[str, asyncio.Future]]):
+        self.batches += 1
+        self.prompts += len(batch)
+        try:
+            completion = await hedger.call(
+                self.model,
+                lambda: clients.llamaguard().completions.create(
+                    model=self.model,
+                    prompt=[prompt for prompt, _ in batch],
+                    temperature=0,
+                ),
+            )
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        texts = {choice.index: choice.text for choice in completion.choices}
+        for index, (_, future) in enumerate(batch):
+            if future.done():
+                continue
+            if index in texts:
+                future.set_result(texts[index])
+            else:
+                future.set_exception(
+                    RuntimeError(f"Llama Guard returned no verdict for prompt {index}")
+                )
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "prompts": self.prompts,
+            "pending": len(self._pending),
+            "mean_batch_size": self.prompts / self.batches if self.batches else 0.0,
+        }
+
+
+moderation_batcher = ModerationBatcher()
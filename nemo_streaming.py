@@ -0,0 +1,123 @@
+import asyncio
+import inspect
+from typing import TYPE_CHECKING, AsyncIterator, List
+
+from config import NEMO_WINDOW_MODE, NEMO_WINDOW_TOKENS
+from hedging import DeadlineExceeded, remaining, within_deadline
+from replay import replay
+from streaming_moderation import WindowBuffer
+
+if TYPE_CHECKING:
+    from nemoguardrails import LLMRails
+
+# The refusal defined in nemoguardrails_config/bot_flows.co.
+NEMO_REFUSAL = (
+    "⚠️ I'm sorry, I can't respond to that. (This message was blocked by the guardrail)"
+)
+
+
+async def _execute(rails: "LLMRails", action_name: str, context: dict, **kwargs):
+    """Run a registered action the way the flow runtime would, injecting the
+    parameters it asks for."""
+    runtime = rails.runtime
+    fn = runtime.action_dispatcher.get_action(action_name)
+    parameters = inspect.signature(fn).parameters
+    if "context" in parameters:
+        kwargs["context"] = context
+    if "config" in parameters:
+        kwargs["config"] = rails.config
+    if "llm_task_manager" in parameters:
+        kwargs["llm_task_manager"] = runtime.llm_task_manager
+    for name, value in runtime.registered_action_params.items():
+        if name in parameters:
+            kwargs[name] = value
+    result, status = await runtime.action_dispatcher.execute_action(action_name, kwargs)
+    if status == "failed":
+        raise RuntimeError(f"NeMo Guardrails action {action_name} failed")
+    return result
+
+
+async def _output_allowed(
+    rails: "LLMRails", query: str, response: str, window: str
+) -> bool:
+    """The output rails of nemoguardrails_config over a partial response: the
+    self check sees everything released so far, sensitive data detection only
+    the new window."""
+    context = {"user_message": query, "bot_message": response}
+    allowed, has_sensitive_data = await asyncio.gather(
+        _execute(rails, "self_check_output", context),
+        _execute(rails, "detect_sensitive_data", context, source="output", text=window),
+    )
+    return allowed and not has_sensitive_data
+
+
+async def stream_rails(
+    rails: "LLMRails",
+    query: str,
+    messages: List[dict],
+    mode: str = NEMO_WINDOW_MODE,
+    window_tokens: int = NEMO_WINDOW_TOKENS,
+) -> AsyncIterator[str]:
+    """Stream the main LLM output of `rails.generate_async` window by window,
+    releasing each only once the output rails pass on it.
+
+    The rails still run over the full message when generation ends and their
+    verdict is final: the unreleased rest is only sent if it matches, and a
+    late block appends the refusal to what was already shown.
+    """
+    from nemoguardrails.streaming import StreamingHandler
+
+    handler = StreamingHandler()
+    # In its own task, so the context variables NeMo Guardrails sets for the
+    # call (current task, explain info) do not leak into the handler.
+    generation = asyncio.ensure_future(
+        rails.generate_async(messages=messages, streaming_handler=handler)
+    )
+    buffer = WindowBuffer(mode, window_tokens)
+    released = ""
+    try:
+        while True:
+            chunk = asyncio.ensure_future(handler.__anext__())
+            # Predefined messages are pushed without ending the stream.
+            left = remaining()
+            await asyncio.wait(
+                {chunk, generation},
+                timeout=None if left is None else max(left, 0),
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            if not chunk.done():
+                chunk.cancel()
+                if not generation.done():
+                    raise DeadlineExceeded("The turn deadline passed")
+                break
+            try:
+                text = chunk.result()
+            except StopAsyncIteration:
+                break
+            for window in buffer.feed(text):
+                # NeMo Guardrails skips the output rails for its own refusal.
+                predefined = NEMO_REFUSAL.startswith(released + window)
+                if not predefined and not await _output_allowed(
+                    rails, query, released + window, window
+                ):
+                    yield ("\n\n" if released else "") + NEMO_REFUSAL
+                    return
+                released += window
+                yield window
+
+        completion = await within_deadline(generation)
+        response = completion.get("content", "")
+        if response.startswith(released):
+            tail = response[len(released) :]
+        elif response == NEMO_REFUSAL:
+            tail = "\n\n" + response
+        else:
+            # The final message is the streamed text without surrounding
+            # quotes and whitespace.
+            tail = buffer.flush() or ""
+        async for message in replay(tail):
+            yield message
+    finally:
+        if not generation.done():
+            generation.cancel()
+            await asyncio.gather(generation, return_exceptions=True)
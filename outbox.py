@@ -0,0 +1,308 @@
+"""Durable outbox of the writes to the Lighthouz API.
+
+    python outbox.py status
+    python outbox.py replay [--failed] [--timeout 60]
+
+replay sends the writes that are due now, and with --failed also those
+the API rejected, then reports what is left. Run it while the app is
+stopped: a running app drains the same outbox.
+"""
+
+import argparse
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from config import OUTBOX_PATH, OUTBOX_RETENTION
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversations (
+    key TEXT PRIMARY KEY,
+    remote_id TEXT,
+    create_body TEXT NOT NULL DEFAULT '{}',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt REAL NOT NULL DEFAULT 0,
+    failed INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    updated REAL NOT NULL DEFAULT 0,
+    version INTEGER,
+    acked TEXT
+);
+CREATE TABLE IF NOT EXISTS writes (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    key TEXT NOT NULL,
+    body TEXT NOT NULL,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS writes_key ON writes (key, id);
+"""
+# Columns added since the first schema, for outboxes created before them.
+ADDED_COLUMNS = {"version": "INTEGER", "acked": "TEXT"}
+
+
+def digest(turn) -> str:
+    return hashlib.blake2b(
+        json.dumps(turn, sort_keys=True).encode(), digest_size=8
+    ).hexdigest()
+
+
+def digests(conversations: List[list]) -> List[List[str]]:
+    return [[digest(turn) for turn in conversation] for conversation in conversations]
+
+
+def _common_prefix(a: List[str], b: List[str]) -> int:
+    for index, (x, y) in enumerate(zip(a, b)):
+        if x != y:
+            return index
+    return min(len(a), len(b))
+
+
+class Batch:
+    """The writes of a conversation that are sent as one request."""
+
+    def __init__(
+        self,
+        key: str,
+        remote_id: Optional[str],
+        create: Dict,
+        attempts: int,
+        writes: List[Tuple[int, Dict]],
+        version: Optional[int] = None,
+        acked: Optional[List[List[str]]] = None,
+    ):
+        self.key = key
+        self.remote_id = remote_id
+        self.create = create
+        self.attempts = attempts
+        # The version of the conversation in the API and digests of the turns
+        # it has, as of the last accepted write.
+        self.version = version
+        self.acked = acked
+        self.last_id = writes[-1][0]
+        self.body: Dict = {}
+        for _, body in writes:
+            self.body.update(body)
+
+    @property
+    def idempotency_key(self) -> str:
+        # A conversation is created once; an update covers its writes up to
+        # last_id, whatever they were merged with.
+        if self.remote_id is None:
+            return f"{self.key}-create"
+        return f"{self.key}-{self.last_id}"
+
+    def delta(self) -> Optional[Dict]:
+        """The body as the turns from the first one that is not in the API,
+        against the acknowledged version; None if that is not known."""
+        conversations = self.body.get("conversations")
+        if conversations is None or self.version is None or self.acked is None:
+            return None
+        if len(conversations) != len(self.acked):
+            return None
+        start = min(
+            _common_prefix(acked, current)
+            for acked, current in zip(self.acked, digests(conversations))
+        )
+        body = {
+            key: value for key, value in self.body.items() if key != "conversations"
+        }
+        body.update(
+            base_version=self.version,
+            start=start,
+            turns=[conversation[start:] for conversation in conversations],
+        )
+        return body
+
+
+class Outbox:
+    """SQLite table of the writes not yet accepted by the API, in WAL mode so
+    that appending does not wait for the flusher, and the conversation IDs
+    the API assigned to them."""
+
+    def __init__(self, path: str = OUTBOX_PATH, retention: float = OUTBOX_RETENTION):
+        self.path = path or ":memory:"
+        # Conversations without writes are forgotten after `retention`
+        # seconds, when no more writes can come for them.
+        self.retention = retention
+        self._pruned = 0.0
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.executescript(SCHEMA)
+        columns = {
+            row[1]
+            for row in self._connection.execute("PRAGMA table_info(conversations)")
+        }
+        for column, kind in ADDED_COLUMNS.items():
+            if column not in columns:
+                self._connection.execute(
+                    f"ALTER TABLE conversations ADD COLUMN {column} {kind}"
+                )
+        self._lock = threading.Lock()
+
+    def append(self, key: str, body: Dict, create: Optional[Dict] = None):
+        with self._lock, self._connection:
+            now = time.time()
+            self._connection.execute(
+                "INSERT OR IGNORE INTO conversations (key) VALUES (?)", (key,)
+            )
+            self._connection.execute(
+                "UPDATE conversations SET updated = ? WHERE key = ?", (now, key)
+            )
+            if create:
+                self._connection.execute(
+                    "UPDATE conversations SET create_body = ? WHERE key = ?",
+                    (json.dumps(create), key),
+                )
+            self._connection.execute(
+                "INSERT INTO writes (key, body, created) VALUES (?, ?, ?)",
+                (key, json.dumps(body), now),
+            )
+
+    def next_batch(
+        self, exclude=(), now: Optional[float] = None
+    ) -> Tuple[Optional[Batch], Optional[float]]:
+        """The oldest due batch of a conversation not in `exclude`, or None
+        and when the next one is due."""
+        now = time.time() if now is None else now
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT c.key, c.remote_id, c.create_body, c.attempts,"
+                " c.next_attempt, c.version, c.acked FROM conversations c JOIN writes w ON w.key = c.key"
+                " WHERE NOT c.failed GROUP BY c.key ORDER BY MIN(w.id)"
+            ).fetchall()
+            next_due = None
+            for row in rows:
+                key, remote_id, create, attempts, next_attempt, version, acked = row
+                if key in exclude:
+                    continue
+                if next_attempt > now:
+                    next_due = min(next_due or next_attempt, next_attempt)
+                    continue
+                writes = self._connection.execute(
+                    "SELECT id, body FROM writes WHERE key = ? ORDER BY id", (key,)
+                ).fetchall()
+                return (
+                    Batch(
+                        key,
+                        remote_id,
+                        json.loads(create),
+                        attempts,
+                        [(id, json.loads(body)) for id, body in writes],
+                        version,
+                        json.loads(acked) if acked else None,
+                    ),
+                    None,
+                )
+            return None, next_due
+
+    def done(
+        self,
+        batch: Batch,
+        remote_id: str,
+        version: Optional[int] = None,
+        acked: Optional[List[List[str]]] = None,
+    ) -> bool:
+        """Remove the writes of a sent batch and record the version the API
+        returned, and the turns it has now if they were sent; True if no
+        writes are left."""
+        with self._lock, self._connection:
+            self._connection.execute(
+                "DELETE FROM writes WHERE key = ? AND id <= ?",
+                (batch.key, batch.last_id),
+            )
+            left = self._connection.execute(
+                "SELECT COUNT(*) FROM writes WHERE key = ?", (batch.key,)
+            ).fetchone()[0]
+            self._connection.execute(
+                "UPDATE conversations SET remote_id = ?, attempts = 0,"
+                " next_attempt = 0, failed = 0, error = NULL, version = ?,"
+                " acked = COALESCE(?, acked) WHERE key = ?",
+                (
+                    remote_id,
+                    version,
+                    json.dumps(acked) if acked is not None else None,
+                    batch.key,
+                ),
+            )
+            now = time.time()
+            if now - self._pruned > 60:
+                self._pruned = now
+                self._connection.execute(
+                    "DELETE FROM conversations WHERE updated < ? AND key NOT IN"
+                    " (SELECT key FROM writes)",
+                    (now - self.retention,),
+                )
+            return not left
+
+    def retry(self, batch: Batch, error: str, delay: float, failed: bool = False):
+        with self._lock, self._connection:
+            self._connection.execute(
+                "UPDATE conversations SET attempts = attempts + 1, next_attempt = ?,"
+                " failed = ?, error = ? WHERE key = ?",
+                (time.time() + delay, int(failed), error, batch.key),
+            )
+
+    def reset(self, failed: bool = False):
+        """Make every write due now, and with `failed` those rejected too."""
+        with self._lock, self._connection:
+            self._connection.execute(
+                "UPDATE conversations SET next_attempt = 0"
+                + (", failed = 0, attempts = 0" if failed else "")
+            )
+
+    def backlog(self) -> int:
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM writes").fetchone()[0]
+
+    def status(self) -> dict:
+        with self._lock:
+            writes, oldest = self._connection.execute(
+                "SELECT COUNT(*), MIN(created) FROM writes"
+            ).fetchone()
+            conversations, failed = self._connection.execute(
+                "SELECT COUNT(DISTINCT c.key), COUNT(DISTINCT CASE WHEN c.failed"
+                " THEN c.key END) FROM conversations c JOIN writes w ON w.key = c.key"
+            ).fetchone()
+            errors = self._connection.execute(
+                "SELECT key, attempts, error FROM conversations"
+                " WHERE error IS NOT NULL ORDER BY next_attempt LIMIT 10"
+            ).fetchall()
+        return {
+            "writes": writes,
+            "conversations": conversations,
+            "failed_conversations": failed,
+            "oldest_seconds": time.time() - oldest if oldest else None,
+            "errors": [
+                {"key": key, "attempts": attempts, "error": error}
+                for key, attempts, error in errors
+            ],
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("command", choices=["status", "replay"])
+    parser.add_argument("--path", default=OUTBOX_PATH)
+    parser.add_argument(
+        "--failed", action="store_true", help="also resend rejected writes"
+    )
+    parser.add_argument("--timeout", type=float, default=60.0)
+    args = parser.parse_args()
+
+    outbox = Outbox(args.path)
+    if args.command == "replay":
+        from persistence import PersistenceWorker
+
+        outbox.reset(failed=args.failed)
+        worker = PersistenceWorker(outbox=outbox)
+        worker.start()
+        worker.flush(args.timeout)
+    print(json.dumps(outbox.status(), indent=2))
+
+
+if __name__ == "__main__":
+    main()
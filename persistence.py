@@ -0,0 +1,274 @@
+import atexit
+import json
+import queue
+import random
+import sqlite3
+import threading
+import time
+import weakref
+from typing import Dict, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from config import (
+    LIGHTHOUZ_API_URL,
+    PERSISTENCE_BACKOFF_SECONDS,
+    PERSISTENCE_CONCURRENCY,
+    PERSISTENCE_DELTAS,
+    PERSISTENCE_MAX_BACKOFF_SECONDS,
+    PERSISTENCE_TIMEOUT,
+)
+from metrics import (
+    outbox_backlog,
+    persistence_bytes,
+    persistence_queue_depth,
+    persistence_seconds,
+    persistence_writes,
+)
+from outbox import Batch, Outbox, digests
+
+
+class PersistenceWorker:
+    """Stores conversations and votes in the Lighthouz API from background
+    threads, so that the handlers return as soon as a write is queued.
+
+    Writes are appended to the outbox first, by a writer thread, keyed by
+    session (anything with `key`, `conversation_id` and `persisted`
+    attributes), and deleted from it once the API accepted them, so that
+    they survive API outages and restarts. The first one of a session is a
+    POST, which has to answer 201 with the conversation ID; later ones are
+    PUTs. Writes of a session that wait while another is in flight are
+    merged into one request. At most `concurrency` requests run at a time
+    over pooled connections, each with an Idempotency-Key header.
+
+    With `deltas`, an update of the histories of a conversation whose API
+    returns versions is sent as a PATCH of the turns from the first one that
+    changed since the last accepted write, which the API applies if its
+    version is still `base_version`; on a conflict the full histories are
+    PUT instead.
+
+    Connection errors, 429 and 5xx are retried with exponential backoff up
+    to `max_backoff`; other errors park the writes until they are replayed
+    with `python outbox.py replay --failed`.
+    """
+
+    def __init__(
+        self,
+        url: Optional[str] = LIGHTHOUZ_API_URL,
+        outbox: Optional[Outbox] = None,
+        concurrency: int = PERSISTENCE_CONCURRENCY,
+        backoff: float = PERSISTENCE_BACKOFF_SECONDS,
+        max_backoff: float = PERSISTENCE_MAX_BACKOFF_SECONDS,
+        timeout: float = PERSISTENCE_TIMEOUT,
+        deltas: bool = PERSISTENCE_DELTAS,
+    ):
+        self.url = url
+        self.deltas = deltas
+        self._outbox = outbox
+        self.concurrency = max(1, concurrency)
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self._sessions = weakref.WeakValueDictionary()
+        self._in_flight = set()
+        # Whether a batch may be due; cleared when a worker found none.
+        self._due = True
+        self._condition = threading.Condition()
+        self._threads = []
+        self._http = None
+        self._outbox_lock = threading.Lock()
+        # Writes not yet appended to the outbox, and how many.
+        self._appends = queue.Queue()
+        self._appending = 0
+
+    @property
+    def outbox(self) -> Outbox:
+        # Opened on first use, so that importing this module creates no file.
+        with self._outbox_lock:
+            if self._outbox is None:
+                self._outbox = Outbox()
+            return self._outbox
+
+    def submit(self, session, body: Dict, create: Optional[Dict] = None):
+        """Queue `body` for the session, with `create` added if it creates the
+        conversation. It is appended to the outbox by the writer thread, so
+        that the event loop never waits for SQLite."""
+        with self._condition:
+            session.persisted = False
+            self._sessions[session.key] = session
+            self._appending += 1
+            self.start()
+        self._appends.put((session.key, body, create))
+
+    def _append(self):
+        outbox_backlog.set(self.outbox.backlog())
+        while True:
+            key, body, create = self._appends.get()
+            try:
+                self.outbox.append(key, body, create)
+            except sqlite3.Error as e:
+                persistence_writes.inc(operation="queue", outcome="failed")
+                print(f"Outbox append failed: {e!r}")
+            else:
+                persistence_writes.inc(operation="queue", outcome="ok")
+                outbox_backlog.inc()
+            with self._condition:
+                self._appending -= 1
+                self._due = True
+                self._condition.notify_all()
+
+    def start(self):
+        """Start the writer and worker threads, which also send what an
+        earlier process left in the outbox."""
+        with self._condition:
+            if self._threads:
+                return
+            self._http = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=1, pool_maxsize=self.concurrency, max_retries=0
+            )
+            self._http.mount("http://", adapter)
+            self._http.mount("https://", adapter)
+            writer = threading.Thread(
+                target=self._append, name="persistence-writer", daemon=True
+            )
+            writer.start()
+            self._threads.append(writer)
+            for index in range(self.concurrency):
+                thread = threading.Thread(
+                    target=self._work, name=f"persistence-{index}", daemon=True
+                )
+                thread.start()
+                self._threads.append(thread)
+            atexit.register(self.flush)
+
+    def _next(self) -> Batch:
+        with self._condition:
+            while True:
+                next_due = None
+                if self._due:
+                    batch, next_due = self.outbox.next_batch(exclude=self._in_flight)
+                    if batch is not None:
+                        self._in_flight.add(batch.key)
+                        persistence_queue_depth.set(len(self._in_flight))
+                        return batch
+                    self._due = False
+                    self._condition.notify_all()
+                timeout = None if next_due is None else max(0, next_due - time.time())
+                if not self._condition.wait(timeout):
+                    self._due = True
+
+    def _work(self):
+        while True:
+            batch = self._next()
+            try:
+                self._write(batch)
+            finally:
+                with self._condition:
+                    self._in_flight.discard(batch.key)
+                    persistence_queue_depth.set(len(self._in_flight))
+                    self._due = True
+                    self._condition.notify_all()
+
+    def _send(self, method: str, url: str, body: Dict, operation: str, headers):
+        data = json.dumps(body).encode()
+        persistence_bytes.inc(len(data), operation=operation)
+        with persistence_seconds.time(operation=operation):
+            return self._http.request(
+                method,
+                url,
+                data=data,
+                headers={**headers, "Content-Type": "application/json"},
+                timeout=self.timeout,
+            )
+
+    def _request(self, batch: Batch) -> requests.Response:
+        headers = {"Idempotency-Key": batch.idempotency_key}
+        if not batch.remote_id:
+            return self._send(
+                "POST",
+                f"{self.url}/",
+                {**batch.body, **batch.create},
+                "create",
+                headers,
+            )
+        url = f"{self.url}/{batch.remote_id}"
+        delta = batch.delta() if self.deltas else None
+        if delta is not None:
+            response = self._send("PATCH", url, delta, "delta", headers)
+            # Anything but a version conflict or an API without deltas is
+            # handled as the response to the write.
+            if response.status_code not in (404, 405, 409, 501):
+                return response
+            persistence_writes.inc(operation="delta", outcome="snapshot")
+            headers = {"Idempotency-Key": f"{batch.idempotency_key}-snapshot"}
+        return self._send("PUT", url, batch.body, "update", headers)
+
+    def _write(self, batch: Batch):
+        operation = "update" if batch.remote_id else "create"
+        retryable = True
+        try:
+            response = self._request(batch)
+        except requests.RequestException as e:
+            error = repr(e)
+        else:
+            result = _json(response) if response.ok else {}
+            # A create is only done once the API returned the conversation ID,
+            # or every later write of the session would POST it again.
+            created = response.status_code == 201 and result.get("_id")
+            if response.ok and (batch.remote_id or created):
+                remote_id = batch.remote_id or result["_id"]
+                conversations = batch.body.get("conversations")
+                sent = self.outbox.done(
+                    batch,
+                    remote_id,
+                    version=result.get("version"),
+                    acked=digests(conversations) if conversations else None,
+                )
+                outbox_backlog.set(self.outbox.backlog())
+                persistence_writes.inc(operation=operation, outcome="ok")
+                session = self._sessions.get(batch.key)
+                if session is not None:
+                    session.conversation_id = remote_id
+                    session.persisted = sent
+                return
+            error = f"{response.status_code} {response.text[:200]}"
+            retryable = response.status_code == 429 or response.status_code >= 500
+            if response.ok:
+                # Not the 201 with an ID of a create: parked like a rejected
+                # write, as retrying would most likely get the same answer.
+                error = f"Unexpected create response: {error}"
+        delay = min(
+            self.max_backoff,
+            self.backoff * 2**batch.attempts * random.uniform(0.5, 1.5),
+        )
+        self.outbox.retry(batch, error, delay, failed=not retryable)
+        persistence_writes.inc(
+            operation=operation, outcome="retried" if retryable else "failed"
+        )
+        if batch.attempts == 0 or not retryable:
+            print(f"Lighthouz API {operation} failed: {error}")
+
+    def flush(self, timeout: float = 10.0) -> bool:
+        """Wait until no writes are being appended, due or in flight; False on
+        timeout."""
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while self._threads and (self._appending or self._due or self._in_flight):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+        return True
+
+
+def _json(response: requests.Response) -> dict:
+    try:
+        result = response.json()
+    except ValueError:
+        return {}
+    return result if isinstance(result, dict) else {}
+
+
+persistence_worker = PersistenceWorker()
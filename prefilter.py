@@ -0,0 +1,99 @@
+import re
+import threading
+import unicodedata
+from collections import Counter
+from typing import Iterable, List, Optional
+
+from config import PREFILTER_MODE, PREFILTER_PATTERNS_PATH
+
+ZERO_WIDTH = dict.fromkeys(map(ord, "\u200b\u200c\u200d\u2060\ufeff\u00ad"))
+
+# Lookalike characters that NFKC leaves alone (Cyrillic, Greek), plus leetspeak.
+HOMOGLYPHS = str.maketrans(
+    "авекмнорстухіјѕԁɡαβεηικνορτυχ013457@$",
+    "abekmhopctyxijsdgabenikvoptuxoieastas",
+)
+
+
+def normalize(text: str) -> str:
+    text = unicodedata.normalize("NFKC", text).translate(ZERO_WIDTH).casefold()
+    text = "".join(
+        c for c in unicodedata.normalize("NFKD", text) if not unicodedata.combining(c)
+    )
+    text = text.translate(HOMOGLYPHS)
+    return " ".join(re.findall(r"[a-z]+", text))
+
+
+def load_patterns(path: Optional[str] = PREFILTER_PATTERNS_PATH) -> List[str]:
+    if not path:
+        return []
+    with open(path, encoding="utf-8") as f:
+        return [
+            line.strip()
+            for line in f
+            if line.strip() and not line.strip().startswith("#")
+        ]
+
+
+class Prefilter:
+    """Tier-0 input filter for the guarded models.
+
+    It refuses a message without asking any guardrail, so its patterns are a
+    short list of unambiguous injection phrasings rather than the examples of
+    the Llama Guard policy, which also occur in harmless messages. Every
+    phrase and regex is compiled into a single alternation with one named
+    group per pattern, so a message is scanned once and the matching pattern
+    is known. In "shadow" mode matches are only counted.
+    """
+
+    def __init__(self, patterns: Iterable[str], mode: str = PREFILTER_MODE):
+        if mode not in ("off", "shadow", "enforce"):
+            raise ValueError(f"Unknown prefilter mode: {mode}")
+        self.mode = mode
+        self.patterns = []
+        alternatives = []
+        for pattern in dict.fromkeys(patterns):
+            if pattern.startswith("re:"):
+                regex = pattern[3:]
+            else:
+                words = normalize(pattern)
+                if not words:
+                    continue
+                regex = rf"\b{re.escape(words)}\b"
+            alternatives.append(f"(?P<p{len(self.patterns)}>{regex})")
+            self.patterns.append(pattern)
+        self._regex = re.compile("|".join(alternatives)) if alternatives else None
+        self._lock = threading.Lock()
+        self.checked = 0
+        self.matches = Counter()
+
+    def match(self, text: str) -> Optional[str]:
+        if self._regex is None:
+            return None
+        found = self._regex.search(normalize(text))
+        if found is None:
+            return None
+        return self.patterns[int(found.lastgroup[1:])]
+
+    def blocks(self, text: str) -> bool:
+        """Return True if `text` should be refused before any remote guardrail
+        runs."""
+        if self.mode == "off":
+            return False
+        pattern = self.match(text)
+        with self._lock:
+            self.checked += 1
+            if pattern is not None:
+                self.matches[pattern] += 1
+        return pattern is not None and self.mode == "enforce"
+
+    def stats(self):
+        with self._lock:
+            return {
+                "mode": self.mode,
+                "checked": self.checked,
+                "matches": dict(self.matches),
+            }
+
+
+prefilter = Prefilter(load_patterns())
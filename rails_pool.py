@@ -0,0 +1,201 @@
+import asyncio
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import (
+    TYPE_CHECKING,
+    Callable,
+    Deque,
+    Dict,
+    Hashable,
+    List,
+    Optional,
+    Tuple,
+)
+
+from config import (
+    NEMOGUARDRAILS_CONFIG_PATH,
+    RAILS_POOL_BUILD_THREADS,
+    RAILS_POOL_IDLE_TTL,
+    RAILS_POOL_MAX_SIZE,
+)
+
+if TYPE_CHECKING:
+    # nemoguardrails is imported on first use; it is slow to import.
+    from nemoguardrails import LLMRails, RailsConfig
+
+_POOL_FULL = object()
+
+
+class RailsPool:
+    """Process-wide pool of compiled LLMRails instances.
+
+    The rails config is parsed once and LLMRails instances are built lazily per
+    key (backend model + generation parameters). An instance is handed out to
+    one caller at a time, so concurrent requests never share a rails object.
+    Callers waiting for a free slot wait on the event loop, and instances are
+    built on threads of their own, so that waiting callers can never hold up
+    the builds they wait for.
+    """
+
+    def __init__(
+        self,
+        config_path: str = NEMOGUARDRAILS_CONFIG_PATH,
+        max_size: int = RAILS_POOL_MAX_SIZE,
+        idle_ttl: float = RAILS_POOL_IDLE_TTL,
+        build_threads: int = RAILS_POOL_BUILD_THREADS,
+    ):
+        self.config_path = config_path
+        self.max_size = max_size
+        self.idle_ttl = idle_ttl
+        self._config: Optional["RailsConfig"] = None
+        self._config_lock = threading.Lock()
+        self._lock = threading.Lock()
+        # Futures of the callers waiting for a free slot, oldest first.
+        self._waiters: Deque[asyncio.Future] = deque()
+        self._builder = ThreadPoolExecutor(
+            max_workers=max(1, build_threads), thread_name_prefix="rails-build"
+        )
+        # key -> list of (rails, last_used) that are free to hand out
+        self._idle: Dict[Hashable, List[Tuple["LLMRails", float]]] = defaultdict(list)
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def config(self) -> "RailsConfig":
+        if self._config is None:
+            from nemoguardrails import RailsConfig
+
+            with self._config_lock:
+                if self._config is None:
+                    self._config = RailsConfig.from_path(self.config_path)
+        return self._config
+
+    def load_config(self) -> "RailsConfig":
+        """Parse the rails config now rather than on the first NeMo battle."""
+        return self.config
+
+    def _evict_idle(self, now: float):
+        for key in list(self._idle):
+            fresh = [
+                (rails, last_used)
+                for rails, last_used in self._idle[key]
+                if now - last_used < self.idle_ttl
+            ]
+            self.evictions += len(self._idle[key]) - len(fresh)
+            self._size -= len(self._idle[key]) - len(fresh)
+            if fresh:
+                self._idle[key] = fresh
+            else:
+                del self._idle[key]
+
+    def _evict_oldest(self) -> bool:
+        oldest_key = None
+        oldest_used = None
+        for key, entries in self._idle.items():
+            for _, last_used in entries:
+                if oldest_used is None or last_used < oldest_used:
+                    oldest_key, oldest_used = key, last_used
+        if oldest_key is None:
+            return False
+        entries = self._idle[oldest_key]
+        entries.sort(key=lambda entry: entry[1])
+        entries.pop(0)
+        if not entries:
+            del self._idle[oldest_key]
+        self._size -= 1
+        self.evictions += 1
+        return True
+
+    def _checkout(self, key: Hashable):
+        with self._lock:
+            self._evict_idle(time.monotonic())
+            if self._idle.get(key):
+                rails, _ = self._idle[key].pop()
+                if not self._idle[key]:
+                    del self._idle[key]
+                self.hits += 1
+                return rails
+            if self._size < self.max_size or self._evict_oldest():
+                self._size += 1
+                self.misses += 1
+                return None
+            return _POOL_FULL
+
+    def _wake_one(self):
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+
+    def _checkin(self, key: Hashable, rails: Optional["LLMRails"]):
+        with self._lock:
+            if rails is None:
+                self._size -= 1
+            else:
+                self._idle[key].append((rails, time.monotonic()))
+        self._wake_one()
+
+    async def _wait_checkout(self, key: Hashable):
+        while True:
+            rails = self._checkout(key)
+            if rails is not _POOL_FULL:
+                return rails
+            # Every instance is in use; wait for one to be returned.
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    # Woken up but cancelled: pass the free slot on.
+                    self._wake_one()
+                else:
+                    self._waiters.remove(waiter)
+                raise
+
+    def _build(self, llm_factory: Callable) -> "LLMRails":
+        from nemoguardrails import LLMRails
+
+        from sensitive_data import detect_sensitive_data
+
+        rails = LLMRails(self.config, llm=llm_factory())
+        # Presidio runs in the sensitive data worker pool instead of the event loop.
+        rails.register_action(detect_sensitive_data, name="detect_sensitive_data")
+        return rails
+
+    @asynccontextmanager
+    async def acquire(self, key: Hashable, llm_factory: Callable):
+        rails = await self._wait_checkout(key)
+        try:
+            if rails is None:
+                # Parsing the config and compiling the rails is CPU-bound and
+                # takes seconds; keep it off the event loop.
+                rails = await asyncio.get_running_loop().run_in_executor(
+                    self._builder, self._build, llm_factory
+                )
+            yield rails
+        except BaseException:
+            # Do not return an instance that failed mid-generation to the pool.
+            self._checkin(key, None)
+            raise
+        else:
+            self._checkin(key, rails)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": self._size,
+                "idle": sum(len(entries) for entries in self._idle.values()),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+rails_pool = RailsPool()
@@ -0,0 +1,52 @@
+import asyncio
+import re
+import time
+from typing import AsyncIterator, Iterator
+
+from config import REPLAY_CHARS_PER_SECOND, REPLAY_CHUNK_SIZE, REPLAY_MODE
+
+WORD = re.compile(r"\s*\S+\s*")
+
+
+def split_chunks(text: str, chunk_size: int = REPLAY_CHUNK_SIZE) -> Iterator[str]:
+    """Split `text` at word boundaries into chunks of at least `chunk_size`
+    characters (the last one may be shorter)."""
+    chunk = ""
+    for match in WORD.finditer(text):
+        chunk += match.group()
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = ""
+    if chunk:
+        yield chunk
+    elif text and not text.strip():
+        yield text
+
+
+async def replay(
+    text: str,
+    mode: str = REPLAY_MODE,
+    chunk_size: int = REPLAY_CHUNK_SIZE,
+    chars_per_second: float = REPLAY_CHARS_PER_SECOND,
+) -> AsyncIterator[str]:
+    """Stream an already moderated response back to the UI.
+
+    "instant" yields the whole text at once, "chunks" yields word-aligned
+    chunks of about `chunk_size` characters as fast as the consumer reads
+    them, and "rate" paces those chunks at `chars_per_second`.
+    """
+    if mode == "instant":
+        if text:
+            yield text
+        return
+    if mode not in ("chunks", "rate"):
+        raise ValueError(f"Unknown replay mode: {mode}")
+    started = time.monotonic()
+    sent = 0
+    for chunk in split_chunks(text, chunk_size):
+        yield chunk
+        sent += len(chunk)
+        if mode == "rate":
+            delay = started + sent / chars_per_second - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
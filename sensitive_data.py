@@ -0,0 +1,253 @@
+import asyncio
+import json
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+
+from config import (
+    SDD_BATCH_MAX_SIZE,
+    SDD_BATCH_MAX_WAIT_MS,
+    SDD_POOL_SIZE,
+    SDD_SPACY_MODEL,
+)
+from metering import arena_model_var
+from metrics import guardrail_verdict_seconds
+
+# nemoguardrails is slow to import, so this module is only imported where
+# NeMo Guardrails are used.
+from nemoguardrails.actions import action
+
+if TYPE_CHECKING:
+    from nemoguardrails import RailsConfig
+
+
+@lru_cache
+def load_analyzer(model_name: str):
+    from presidio_analyzer import AnalyzerEngine, BatchAnalyzerEngine
+    from presidio_analyzer.nlp_engine import NlpEngineProvider
+
+    provider = NlpEngineProvider(
+        nlp_configuration={
+            "nlp_engine_name": "spacy",
+            "models": [{"lang_code": "en", "model_name": model_name}],
+        }
+    )
+    return BatchAnalyzerEngine(AnalyzerEngine(nlp_engine=provider.create_engine()))
+
+
+def analyze_batch(
+    model_name: str, texts: List[str], entities: List[str], recognizers: str
+) -> List[bool]:
+    """Whether each of `texts` contains any of `entities`. Runs in the pool
+    workers, with spaCy processing the texts as one batch."""
+    from presidio_analyzer import PatternRecognizer
+
+    results = load_analyzer(model_name).analyze_iterator(
+        texts,
+        language="en",
+        batch_size=len(texts),
+        entities=entities,
+        ad_hoc_recognizers=[
+            PatternRecognizer.from_dict(recognizer)
+            for recognizer in json.loads(recognizers)
+        ],
+    )
+    return [bool(result) for result in results]
+
+
+def _ping():
+    return True
+
+
+# A failed start is not retried for this long, so that every rail call does
+# not try to start the workers again.
+START_RETRY_SECONDS = 60.0
+
+
+class SensitiveDataDetector:
+    """Runs Presidio sensitive data detection in a pool of worker processes,
+    so that spaCy does not hold the GIL of the process serving the UI.
+
+    The workers are forked from a fork server rather than from this process,
+    which runs threads by then. The fork server loads the analyzer first
+    (see sensitive_data_preload), so the workers share the spaCy model
+    copy-on-write; where there is no fork server, each spawned worker loads
+    its own. Texts submitted concurrently are batched like the Llama Guard
+    prompts. With `pool_size` 0 the batches run in a thread instead, with
+    the analyzer loaded in this process.
+    """
+
+    def __init__(
+        self,
+        pool_size: int = SDD_POOL_SIZE,
+        model_name: str = SDD_SPACY_MODEL,
+        max_batch_size: int = SDD_BATCH_MAX_SIZE,
+        max_wait_ms: float = SDD_BATCH_MAX_WAIT_MS,
+    ):
+        self.pool_size = pool_size
+        self.model_name = model_name
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait_ms / 1000
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+        self._started = False
+        # The error of the last start and when it failed.
+        self._start_error: Optional[Exception] = None
+        self._start_failed_at = 0.0
+        self._pending: Dict[Tuple, List[Tuple[str, asyncio.Future]]] = {}
+        self._timers: Dict[Tuple, asyncio.TimerHandle] = {}
+        self._sending = set()
+        self.batches = 0
+        self.texts = 0
+        self.restarts = 0
+
+    def start(self):
+        """Start the workers and load the analyzer; blocks for a few
+        seconds. Raises the error of a failed start again until
+        START_RETRY_SECONDS have passed."""
+        with self._lock:
+            if self._started:
+                return
+            if (
+                self._start_error is not None
+                and time.monotonic() - self._start_failed_at < START_RETRY_SECONDS
+            ):
+                raise self._start_error
+            try:
+                self._start()
+            except Exception as e:
+                if self._pool is not None:
+                    self._pool.shutdown(wait=False, cancel_futures=True)
+                    self._pool = None
+                self._start_error = e
+                self._start_failed_at = time.monotonic()
+                raise
+            self._start_error = None
+            self._started = True
+
+    def _start(self):
+        if self.pool_size <= 0:
+            load_analyzer(self.model_name)
+            return
+        # Forking a process that runs threads can deadlock the child on a lock
+        # one of them held. Spawned workers would import the app's main module
+        # instead of just this one.
+        if "forkserver" in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context("forkserver")
+            # The fork server, started with the first worker, reads the model
+            # to preload from its environment. It imports the module from the
+            # working directory, the repository root, as Python 3.11 does not
+            # pass it sys.path.
+            os.environ["SDD_SPACY_MODEL"] = self.model_name
+            context.set_forkserver_preload(["sensitive_data_preload"])
+        else:
+            context = multiprocessing.get_context("spawn")
+        # A no-op in workers forked with the analyzer loaded.
+        self._pool = ProcessPoolExecutor(
+            self.pool_size,
+            mp_context=context,
+            initializer=load_analyzer,
+            initargs=(self.model_name,),
+        )
+        # Workers are started on demand; make them all start now.
+        futures = [self._pool.submit(_ping) for _ in range(self.pool_size)]
+        for future in futures:
+            future.result()
+
+    def _restart(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=False, cancel_futures=True)
+                self._pool = None
+            self._started = False
+            self.restarts += 1
+
+    async def detect(self, source: str, text: str, config: "RailsConfig") -> bool:
+        sdd_config = config.rails.config.sensitive_data_detection
+        assert source in ["input", "output", "retrieval"]
+        entities = getattr(sdd_config, source).entities
+        if not entities:
+            return False
+        if not self._started:
+            await asyncio.to_thread(self.start)
+
+        key = (tuple(entities), json.dumps(sdd_config.recognizers, sort_keys=True))
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        pending = self._pending.setdefault(key, [])
+        pending.append((text, future))
+        if len(pending) >= self.max_batch_size:
+            self._flush(key)
+        elif key not in self._timers:
+            self._timers[key] = loop.call_later(self.max_wait, self._flush, key)
+        return await future
+
+    def _flush(self, key: Tuple):
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self._pending.pop(key, [])
+        if batch:
+            task = asyncio.ensure_future(self._send(key, batch))
+            self._sending.add(task)
+            task.add_done_callback(self._sending.discard)
+
+    async def _send(self, key: Tuple, batch: List[Tuple[str, asyncio.Future]]):
+        self.batches += 1
+        self.texts += len(batch)
+        entities, recognizers = key
+        args = (
+            self.model_name,
+            [text for text, _ in batch],
+            list(entities),
+            recognizers,
+        )
+        try:
+            if self._pool is None:
+                results = await asyncio.to_thread(analyze_batch, *args)
+            else:
+                try:
+                    results = await asyncio.get_running_loop().run_in_executor(
+                        self._pool, analyze_batch, *args
+                    )
+                except BrokenProcessPool:
+                    # A worker died (e.g. out of memory); answer this batch
+                    # here and start a fresh pool on the next call.
+                    self._restart()
+                    results = await asyncio.to_thread(analyze_batch, *args)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    def stats(self):
+        return {
+            "pool_size": self.pool_size if self._pool is not None else 0,
+            "model": self.model_name,
+            "batches": self.batches,
+            "texts": self.texts,
+            "mean_batch_size": self.texts / self.batches if self.batches else 0.0,
+            "restarts": self.restarts,
+        }
+
+
+detector = SensitiveDataDetector()
+
+
+@action(is_system_action=True)
+async def detect_sensitive_data(source: str, text: str, config: "RailsConfig"):
+    """Drop-in replacement for the `detect_sensitive_data` action of NeMo
+    Guardrails, registered on every pooled LLMRails instance."""
+    with guardrail_verdict_seconds.time(
+        model=arena_model_var.get(), guardrail=f"sensitive_data_{source}"
+    ):
+        return await detector.detect(source, text, config)
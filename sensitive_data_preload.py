@@ -0,0 +1,19 @@
+"""Preloaded by the fork server of the sensitive data workers.
+
+Loading the analyzer here, before the fork server forks any worker, lets
+the workers share the spaCy model copy-on-write instead of each loading its
+own copy. Frozen objects are left out of garbage collection, so that the
+collector does not write to their pages.
+"""
+
+import gc
+
+from config import SDD_SPACY_MODEL
+from sensitive_data import load_analyzer
+
+try:
+    load_analyzer(SDD_SPACY_MODEL)
+except (ImportError, OSError) as e:
+    # The workers load it themselves and report the error from there.
+    print(f"Preloading {SDD_SPACY_MODEL} failed: {e!r}")
+gc.freeze()
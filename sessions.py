@@ -0,0 +1,99 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+import gradio as gr
+
+from config import SESSION_MAX_SIZE, SESSION_TTL_SECONDS
+from guardrails_models import get_random_models, get_random_system_prompt
+
+SESSION_EXPIRED_MESSAGE = "This round has expired. Please start a new round."
+
+
+class Session:
+    """A round of the arena: the two models, their system prompt, the
+    conversation with each and where it is stored in the Lighthouz API."""
+
+    def __init__(self, llms: List[dict], system_prompt: str):
+        # The session ID, which also keys its writes in the outbox.
+        self.key = uuid.uuid4().hex
+        self.llms = llms
+        self.system_prompt = system_prompt
+        self.histories: Tuple[list, list] = ([], [])
+        self.conversation_id: Optional[str] = None
+        # Whether the Lighthouz API has the histories as they are now.
+        self.persisted = False
+        self.touched = time.monotonic()
+
+
+class SessionStore:
+    """The sessions of the arena in memory, so that the UI only holds a
+    session ID. Sessions idle for `ttl` seconds expire, and the least
+    recently used ones are dropped beyond `max_size`."""
+
+    def __init__(
+        self, max_size: int = SESSION_MAX_SIZE, ttl: float = SESSION_TTL_SECONDS
+    ):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._sessions: "OrderedDict[str, Session]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.expired = 0
+
+    def _evict(self, now: float):
+        while self._sessions:
+            session = next(iter(self._sessions.values()))
+            if len(self._sessions) <= self.max_size and (
+                not self.ttl or now - session.touched < self.ttl
+            ):
+                break
+            self._sessions.popitem(last=False)
+            self.expired += 1
+
+    def new(
+        self, llms: Optional[List[dict]] = None, system_prompt: Optional[str] = None
+    ) -> str:
+        """Start a round, with random models and system prompt unless given,
+        and return its session ID."""
+        session = Session(
+            llms or get_random_models(), system_prompt or get_random_system_prompt()
+        )
+        with self._lock:
+            self._sessions[session.key] = session
+            self._evict(session.touched)
+        return session.key
+
+    def renew(self, session_id: Optional[str]) -> str:
+        """End a round and start the next one."""
+        self.drop(session_id)
+        return self.new()
+
+    def get(self, session_id: Optional[str]) -> Optional[Session]:
+        now = time.monotonic()
+        with self._lock:
+            self._evict(now)
+            session = self._sessions.get(session_id)
+            if session is not None:
+                session.touched = now
+                self._sessions.move_to_end(session_id)
+            return session
+
+    def drop(self, session_id: Optional[str]):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+
+session_store = SessionStore()
+
+
+def get_session(session_id: Optional[str]) -> Session:
+    """The session of a UI event, or a gr.Error if it expired."""
+    session = session_store.get(session_id)
+    if session is None:
+        raise gr.Error(SESSION_EXPIRED_MESSAGE)
+    return session
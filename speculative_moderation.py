@@ -0,0 +1,128 @@
+import asyncio
+import threading
+import time
+from typing import AsyncIterator, Callable, Optional
+
+from history import MESSAGE_OVERHEAD, count_tokens
+from llamaguard_moderator import moderate_query
+
+
+class InputBlocked(Exception):
+    pass
+
+
+class SpeculationStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.runs = 0
+        self.blocked = 0
+        self.saved_seconds = 0.0
+        self.wasted_tokens = 0
+
+    def record(self, blocked: bool, saved_seconds: float, wasted_tokens: int):
+        with self._lock:
+            self.runs += 1
+            self.blocked += int(blocked)
+            self.saved_seconds += saved_seconds
+            self.wasted_tokens += wasted_tokens
+
+    def stats(self):
+        with self._lock:
+            return {
+                "runs": self.runs,
+                "blocked": self.blocked,
+                "saved_seconds": self.saved_seconds,
+                "wasted_tokens": self.wasted_tokens,
+            }
+
+
+speculation_stats = SpeculationStats()
+
+
+def _tokens(chunks) -> int:
+    # Output tokens, without the per-message overhead count_tokens adds.
+    return count_tokens("".join(chunks)) - MESSAGE_OVERHEAD if chunks else 0
+
+
+async def _cancel(task: Optional[asyncio.Future]):
+    if task is None or task.done():
+        return
+    task.cancel()
+    try:
+        await task
+    except (asyncio.CancelledError, StopAsyncIteration):
+        pass
+
+
+async def speculative_stream(
+    query: str, start_stream: Callable[[], AsyncIterator[str]]
+) -> AsyncIterator[str]:
+    """Run `moderate_query` while the upstream stream is already generating.
+
+    Chunks are held back until the verdict arrives. On an unsafe verdict the
+    pending upstream read is cancelled, the stream is closed and InputBlocked
+    is raised before anything was yielded, so callers see the same outcome as
+    moderating first.
+    """
+    started = time.monotonic()
+    verdict = asyncio.ensure_future(moderate_query(query))
+    chunks = start_stream()
+    held = []
+    first_chunk_latency = None
+    next_chunk = None
+    exhausted = False
+    try:
+        try:
+            while not verdict.done():
+                next_chunk = asyncio.ensure_future(chunks.__anext__())
+                await asyncio.wait(
+                    {verdict, next_chunk}, return_when=asyncio.FIRST_COMPLETED
+                )
+                if not next_chunk.done():
+                    break
+                try:
+                    chunk = next_chunk.result()
+                except StopAsyncIteration:
+                    exhausted = True
+                    break
+                finally:
+                    if next_chunk.done():
+                        next_chunk = None
+                if first_chunk_latency is None:
+                    first_chunk_latency = time.monotonic() - started
+                held.append(chunk)
+        except Exception:
+            # The guardrail verdict takes precedence over upstream errors,
+            # exactly as when moderation runs first.
+            if not await verdict:
+                speculation_stats.record(True, 0.0, _tokens(held))
+                raise InputBlocked()
+            raise
+        allowed = await verdict
+        moderation_latency = time.monotonic() - started
+        if not allowed:
+            await _cancel(next_chunk)
+            speculation_stats.record(True, 0.0, _tokens(held))
+            raise InputBlocked()
+        # Sequentially this turn would have waited for moderation and then
+        # for the first token; speculation overlaps the shorter of the two.
+        speculation_stats.record(
+            False, min(moderation_latency, first_chunk_latency or moderation_latency), 0
+        )
+        for chunk in held:
+            yield chunk
+        if next_chunk is not None:
+            try:
+                yield await next_chunk
+            except StopAsyncIteration:
+                exhausted = True
+            next_chunk = None
+        if not exhausted:
+            async for chunk in chunks:
+                yield chunk
+    finally:
+        await _cancel(next_chunk)
+        await _cancel(verdict)
+        aclose = getattr(chunks, "aclose", None)
+        if aclose:
+            await aclose()
@@ -0,0 +1,90 @@
+import re
+from typing import AsyncIterator, List, Optional
+
+from config import LLAMAGUARD_WINDOW_MODE, LLAMAGUARD_WINDOW_TOKENS
+from llamaguard_moderator import moderate_response
+
+OUTPUT_BLOCKED_MESSAGE = (
+    "⚠️ I'm sorry, I cannot respond to that. (The output was blocked by the guardrail)"
+)
+
+SENTENCE_END = re.compile(r"[.!?:;\n]+[\"')\]]*\s")
+
+
+class WindowBuffer:
+    """Groups streamed chunks into moderation windows.
+
+    In "sentence" mode a window closes at the first sentence boundary, or once
+    it holds `window_tokens` whitespace-separated tokens, whichever comes
+    first. In "tokens" mode windows are exactly `window_tokens` tokens long.
+    """
+
+    def __init__(
+        self,
+        mode: str = LLAMAGUARD_WINDOW_MODE,
+        window_tokens: int = LLAMAGUARD_WINDOW_TOKENS,
+    ):
+        if mode not in ("sentence", "tokens"):
+            raise ValueError(f"Unknown moderation window mode: {mode}")
+        self.mode = mode
+        self.window_tokens = max(1, window_tokens)
+        self._text = ""
+
+    def _split_at(self) -> Optional[int]:
+        if self.mode == "sentence":
+            match = SENTENCE_END.search(self._text)
+            if match:
+                return match.end()
+        tokens = list(re.finditer(r"\S+\s", self._text))
+        if len(tokens) >= self.window_tokens:
+            return tokens[self.window_tokens - 1].end()
+        return None
+
+    def feed(self, chunk: str) -> List[str]:
+        self._text += chunk
+        windows = []
+        end = self._split_at()
+        while end:
+            windows.append(self._text[:end])
+            self._text = self._text[end:]
+            end = self._split_at()
+        return windows
+
+    def flush(self) -> Optional[str]:
+        text, self._text = self._text, ""
+        return text or None
+
+
+async def moderate_stream(
+    query: str,
+    chunks: AsyncIterator[str],
+    mode: str = LLAMAGUARD_WINDOW_MODE,
+    window_tokens: int = LLAMAGUARD_WINDOW_TOKENS,
+) -> AsyncIterator[str]:
+    """Yield `chunks` window by window, releasing each only once Llama Guard
+    has judged the accumulated response safe. The upstream stream is closed
+    as soon as a window is flagged."""
+    buffer = WindowBuffer(mode, window_tokens)
+    released = ""
+
+    async def check(window):
+        return await moderate_response(query=query, response=released + window)
+
+    try:
+        async for chunk in chunks:
+            for window in buffer.feed(chunk):
+                if not await check(window):
+                    yield ("\n\n" if released else "") + OUTPUT_BLOCKED_MESSAGE
+                    return
+                released += window
+                yield window
+        window = buffer.flush()
+        if window:
+            if not await check(window):
+                yield ("\n\n" if released else "") + OUTPUT_BLOCKED_MESSAGE
+                return
+            yield window
+    finally:
+        aclose = getattr(chunks, "aclose", None)
+        if aclose:
+            await aclose()
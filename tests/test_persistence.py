@@ -0,0 +1,202 @@
+import json
+import time
+
+import pytest
+import requests
+
+from outbox import Batch, Outbox, digests
+from persistence import PersistenceWorker
+
+
+class Session:
+    def __init__(self, key):
+        self.key = key
+        self.conversation_id = None
+        self.persisted = False
+
+
+class StubHTTP:
+    """Answers requests with the given (status, body) pairs in turn, and
+    records them."""
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    def request(self, method, url, data=None, headers=None, timeout=None):
+        self.requests.append((method, url, json.loads(data), headers))
+        status, body = self.responses.pop(0)
+        response = requests.Response()
+        response.status_code = status
+        response._content = json.dumps(body).encode()
+        return response
+
+
+@pytest.fixture
+def outbox():
+    return Outbox(":memory:")
+
+
+def worker_for(outbox, *responses, deltas=False):
+    worker = PersistenceWorker(
+        url="http://api", outbox=outbox, backoff=10, max_backoff=100, deltas=deltas
+    )
+    worker._http = StubHTTP(*responses)
+    return worker
+
+
+def conversations(*turns):
+    return [[list(turn) for turn in turns], [list(turn) for turn in turns]]
+
+
+def test_next_batch_merges_writes(outbox):
+    outbox.append("a", {"conversations": [[1]], "vote": None}, create={"m": "x"})
+    outbox.append("b", {"conversations": [[9]]})
+    outbox.append("a", {"conversations": [[1, 2]]})
+    outbox.append("a", {"vote": "left"})
+
+    batch, _ = outbox.next_batch()
+    assert batch.key == "a"
+    assert batch.body == {"conversations": [[1, 2]], "vote": "left"}
+    assert batch.create == {"m": "x"}
+    assert batch.idempotency_key == "a-create"
+
+    other, _ = outbox.next_batch(exclude={"a"})
+    assert other.key == "b"
+    assert outbox.next_batch(exclude={"a", "b"}) == (None, None)
+
+
+def test_done_keeps_writes_appended_after_the_batch(outbox):
+    outbox.append("a", {"vote": None})
+    batch, _ = outbox.next_batch()
+    outbox.append("a", {"vote": "left"})
+
+    assert not outbox.done(batch, "remote", version=1)
+    batch, _ = outbox.next_batch()
+    assert batch.body == {"vote": "left"}
+    assert batch.remote_id == "remote"
+    assert batch.idempotency_key == f"a-{batch.last_id}"
+    assert outbox.done(batch, "remote", version=2)
+    assert outbox.backlog() == 0
+
+
+def test_delta_sends_turns_from_the_first_change():
+    acked = conversations(("hi", "hello"), ("how", "fine"))
+    current = conversations(("hi", "hello"), ("how", "great"), ("and", "you"))
+    batch = Batch(
+        "a",
+        "remote",
+        {},
+        0,
+        [(1, {"conversations": current, "vote": None})],
+        version=3,
+        acked=digests(acked),
+    )
+    assert batch.delta() == {
+        "vote": None,
+        "base_version": 3,
+        "start": 1,
+        "turns": [current[0][1:], current[1][1:]],
+    }
+    assert (
+        Batch("a", "remote", {}, 0, [(1, {"conversations": current})]).delta() is None
+    )
+
+
+def test_create_records_the_conversation_id(outbox):
+    session = Session("a")
+    worker = worker_for(outbox, (201, {"_id": "remote", "version": 1}))
+    worker._sessions["a"] = session
+    outbox.append("a", {"conversations": conversations(("hi", "hello"))}, {"m": "x"})
+
+    worker._write(outbox.next_batch()[0])
+    method, url, body, headers = worker._http.requests[0]
+    assert (method, url) == ("POST", "http://api/")
+    assert body["m"] == "x"
+    assert headers["Idempotency-Key"] == "a-create"
+    assert (session.conversation_id, session.persisted) == ("remote", True)
+    assert outbox.backlog() == 0
+
+
+@pytest.mark.parametrize("status, body", [(201, {}), (200, {"_id": "remote"})])
+def test_create_without_201_and_id_is_parked(outbox, status, body):
+    worker = worker_for(outbox, (status, body))
+    outbox.append("a", {"vote": None})
+
+    worker._write(outbox.next_batch()[0])
+    assert outbox.next_batch() == (None, None)
+    status = outbox.status()
+    assert status["failed_conversations"] == 1
+    assert status["errors"][0]["error"].startswith("Unexpected create response")
+
+
+def test_server_errors_are_retried_with_backoff(outbox):
+    worker = worker_for(outbox, (503, {}), (503, {}))
+    outbox.append("a", {"vote": None})
+
+    # Backoff of 10 s doubling per attempt, jittered by ±50%.
+    started = time.time()
+    worker._write(outbox.next_batch()[0])
+    batch, next_due = outbox.next_batch()
+    assert batch is None
+    assert started + 5 <= next_due <= time.time() + 15
+
+    batch, _ = outbox.next_batch(now=next_due)
+    assert batch.attempts == 1
+    started = time.time()
+    worker._write(batch)
+    _, next_due = outbox.next_batch()
+    assert started + 10 <= next_due <= time.time() + 30
+    assert outbox.status()["failed_conversations"] == 0
+
+
+def test_client_errors_are_parked(outbox):
+    worker = worker_for(outbox, (400, {"error": "bad"}))
+    outbox.append("a", {"vote": None})
+
+    worker._write(outbox.next_batch()[0])
+    assert outbox.next_batch() == (None, None)
+    assert outbox.status()["failed_conversations"] == 1
+
+
+def sent_update(outbox):
+    """An outbox with a conversation whose first turn the API acknowledged
+    at version 1, and a second turn to send."""
+    outbox.append("a", {"conversations": conversations(("hi", "hello"))})
+    batch, _ = outbox.next_batch()
+    outbox.done(batch, "remote", 1, digests(batch.body["conversations"]))
+    outbox.append("a", {"conversations": conversations(("hi", "hello"), ("q", "a"))})
+    return outbox.next_batch()[0]
+
+
+def test_delta_is_patched(outbox):
+    batch = sent_update(outbox)
+    worker = worker_for(outbox, (200, {"version": 2}), deltas=True)
+
+    worker._write(batch)
+    [(method, url, body, _)] = worker._http.requests
+    assert (method, url) == ("PATCH", "http://api/remote")
+    assert (body["base_version"], body["start"]) == (1, 1)
+    assert outbox.backlog() == 0
+
+
+@pytest.mark.parametrize("status", [404, 405, 409, 501])
+def test_rejected_delta_falls_back_to_put(outbox, status):
+    batch = sent_update(outbox)
+    worker = worker_for(outbox, (status, {}), (200, {"version": 2}), deltas=True)
+
+    worker._write(batch)
+    (patch, _, _, _), (put, url, body, headers) = worker._http.requests
+    assert (patch, put, url) == ("PATCH", "PUT", "http://api/remote")
+    assert body == batch.body
+    assert headers["Idempotency-Key"] == f"{batch.idempotency_key}-snapshot"
+    assert outbox.backlog() == 0
+
+
+def test_other_delta_errors_are_not_put(outbox):
+    batch = sent_update(outbox)
+    worker = worker_for(outbox, (400, {}), deltas=True)
+
+    worker._write(batch)
+    assert [method for method, *_ in worker._http.requests] == ["PATCH"]
+    assert outbox.status()["failed_conversations"] == 1
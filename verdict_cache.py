@@ -0,0 +1,164 @@
+import asyncio
+import hashlib
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable, Dict, Optional
+
+from config import VERDICT_CACHE_PATH, VERDICT_CACHE_SIZE, VERDICT_CACHE_TTL
+
+
+def normalize(text: str) -> str:
+    text = unicodedata.normalize("NFKC", text)
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def cache_key(role: str, content: str) -> str:
+    return hashlib.sha256(
+        f"{normalize(role)}\x00{normalize(content)}".encode("utf-8")
+    ).hexdigest()
+
+
+class VerdictCache:
+    """LRU+TTL cache of Llama Guard verdicts with an optional SQLite tier.
+
+    Llama Guard runs at temperature 0, so a verdict only depends on the role
+    and the (normalized) content. Concurrent lookups of the same key share a
+    single upstream call. The SQLite tier is read and written on a thread of
+    its own, so that the event loop never waits for the disk.
+    """
+
+    def __init__(
+        self,
+        max_size: int = VERDICT_CACHE_SIZE,
+        ttl: float = VERDICT_CACHE_TTL,
+        path: Optional[str] = VERDICT_CACHE_PATH,
+    ):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._in_flight: Dict[str, asyncio.Future] = {}
+        self._db = None
+        self._db_executor = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS verdicts "
+                "(key TEXT PRIMARY KEY, allowed INTEGER, expires REAL)"
+            )
+            self._db.commit()
+            self._db_executor = ThreadPoolExecutor(1, thread_name_prefix="verdicts")
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def _get(self, key: str) -> Optional[bool]:
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                allowed, expires = entry
+                if expires > now:
+                    self._entries.move_to_end(key)
+                    self.memory_hits += 1
+                    return allowed
+                del self._entries[key]
+        return None
+
+    def _load(self, key: str) -> Optional[tuple]:
+        return self._db.execute(
+            "SELECT allowed, expires FROM verdicts WHERE key = ?", (key,)
+        ).fetchone()
+
+    async def _get_stored(self, key: str) -> Optional[bool]:
+        row = await asyncio.get_running_loop().run_in_executor(
+            self._db_executor, self._load, key
+        )
+        if row is None or row[1] <= time.time():
+            return None
+        with self._lock:
+            self._remember(key, bool(row[0]), row[1])
+            self.disk_hits += 1
+        return bool(row[0])
+
+    def _remember(self, key: str, allowed: bool, expires: float):
+        self._entries[key] = (allowed, expires)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def _store(self, key: str, allowed: bool, expires: float):
+        try:
+            with self._db:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO verdicts VALUES (?, ?, ?)",
+                    (key, int(allowed), expires),
+                )
+        except sqlite3.Error as e:
+            print(f"Storing a verdict failed: {e!r}")
+
+    def _set(self, key: str, allowed: bool):
+        expires = time.time() + self.ttl
+        with self._lock:
+            self._remember(key, allowed, expires)
+        if self._db is not None:
+            self._db_executor.submit(self._store, key, allowed, expires)
+
+    async def get_or_compute(
+        self, role: str, content: str, compute: Callable[[], Awaitable[bool]]
+    ) -> bool:
+        key = cache_key(role, content)
+        allowed = self._get(key)
+        if allowed is None and self._db is not None:
+            allowed = await self._get_stored(key)
+        if allowed is not None:
+            return allowed
+        in_flight = self._in_flight.get(key)
+        if in_flight is not None:
+            self.coalesced += 1
+            try:
+                return await asyncio.shield(in_flight)
+            except asyncio.CancelledError:
+                if not in_flight.cancelled():
+                    raise
+                # The caller that owned the upstream request went away.
+                return await self.get_or_compute(role, content, compute)
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = future
+        try:
+            allowed = await compute()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Nobody may be waiting; do not warn about an unretrieved exception.
+            future.exception()
+            raise
+        else:
+            self._set(key, allowed)
+            future.set_result(allowed)
+            return allowed
+        finally:
+            del self._in_flight[key]
+
+    def stats(self):
+        lookups = self.memory_hits + self.disk_hits + self.misses + self.coalesced
+        return {
+            "size": len(self._entries),
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "hit_rate": (lookups - self.misses) / lookups if lookups else 0.0,
+        }
+
+
+verdict_cache = VerdictCache()
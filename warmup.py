@@ -0,0 +1,57 @@
+import importlib
+import threading
+import time
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, Iterable
+
+from config import STARTUP_WARMUP
+
+# Modules the model functions import on first use, slowest first.
+PROVIDER_MODULES = [
+    "nemoguardrails",
+    "langchain_google_genai",
+    "google.generativeai.types",
+    "openai",
+    "langchain_openai",
+    "langchain_core.messages",
+]
+
+
+def import_modules(modules: Iterable[str] = PROVIDER_MODULES) -> Dict[str, float]:
+    timings = {}
+    for name in modules:
+        started = time.perf_counter()
+        importlib.import_module(name)
+        timings[name] = time.perf_counter() - started
+    return timings
+
+
+def warm_up() -> Dict[str, float]:
+    from history import count_tokens
+    from rails_pool import rails_pool
+
+    timings = import_modules()
+    started = time.perf_counter()
+    rails_pool.load_config()
+    timings["nemoguardrails_config"] = time.perf_counter() - started
+    # Presidio and the spaCy model behind "detect sensitive data on output"
+    # load on the first NeMo battle otherwise; this also starts the workers.
+    started = time.perf_counter()
+    try:
+        from sensitive_data import detector
+
+        detector.start()
+    except (ImportError, OSError, BrokenProcessPool) as e:
+        # The workers fail to start without the spaCy model; the detector
+        # reports that again on the first NeMo battle.
+        print(e)
+    timings["sensitive_data_analyzer"] = time.perf_counter() - started
+    started = time.perf_counter()
+    count_tokens("")
+    timings["tokenizer"] = time.perf_counter() - started
+    return timings
+
+
+def start_background_warmup():
+    if STARTUP_WARMUP:
+        threading.Thread(target=warm_up, name="startup-warmup", daemon=True).start()